@@ -0,0 +1,125 @@
+import gzip
+import array
+import calendar
+import datetime
+import numpy
+try:
+   import xml.etree.cElementTree as ElementTree
+except ImportError:
+   import xml.etree.ElementTree as ElementTree
+
+# same document layout as gpxpy produces, so files are interchangeable
+HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" version="1.1" creator="gpx.py -- https://github.com/tkrajina/gpxpy">
+  <trk>
+    <trkseg>'''
+FOOTER = '''
+    </trkseg>
+  </trk>
+</gpx>'''
+
+
+def open_gpx(filename, mode='rb'):
+    '''Open GPX file, files with .gz suffix are gzip compressed'''
+    if filename.endswith('.gz'):
+       return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def parse_time(string):
+    '''Parse GPX (ISO 8601) time into unix time'''
+    string = string.strip()
+    seconds = calendar.timegm( (int(string[0:4]), int(string[5:7]), int(string[8:10]), int(string[11:13]), int(string[14:16]), int(string[17:19])) )
+    rest = string[19:]
+    if rest.startswith('.'):
+       end = 1
+       while end < len(rest) and rest[end].isdigit():
+           end = end + 1
+       seconds = seconds + float(rest[:end])
+       rest = rest[end:]
+    if rest and rest!='Z':
+       sign = -1 if rest[0]=='-' else 1
+       hours, minutes = rest[1:3], rest[-2:]
+       seconds = seconds - sign * (int(hours)*3600 + int(minutes)*60)
+    return seconds
+
+
+def local_name(tag):
+    return tag[tag.rfind('}')+1:]
+
+
+def iter_points(f):
+    '''Yield (lat, lon, ele, time) of every track point of GPX file `f`,
+       missing elevation and time are None, time is unix time. Parsed
+       elements are dropped right away, so memory use doesn't depend on
+       track length'''
+    parents = []
+    for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+        if event=='start':
+           parents.append(elem)
+           continue
+        parents.pop()
+        if local_name(elem.tag)!='trkpt':
+           continue
+
+        ele = None
+        tst = None
+        for child in elem:
+            name = local_name(child.tag)
+            if name=='ele' and child.text:
+               ele = float(child.text)
+            elif name=='time' and child.text:
+               tst = parse_time(child.text)
+        yield (float(elem.get('lat')), float(elem.get('lon')), ele, tst)
+        elem.clear()
+        if parents:
+           parents[-1].remove(elem)
+
+
+def read_arrays(filename):
+    '''Read track points of GPX file (gzip compressed if name ends with .gz)
+       into lat, lon, ele, time numpy arrays, missing values are NaN'''
+    columns = [ array.array('d') for i in range(4) ]
+    nan = float('nan')
+    with open_gpx(filename) as f:
+         for point in iter_points(f):
+             for column, value in zip(columns, point):
+                 column.append( nan if value is None else value )
+    return tuple( numpy.frombuffer(column, dtype=numpy.float64) if len(column) else numpy.zeros(0) for column in columns )
+
+
+def format_number(value):
+    if isinstance(value, float):
+       s = str(value)
+       if 'e' not in s:
+          return s
+       # scientific notation is illegal in GPX 1.1
+       return format(value, '.10f').rstrip('0.')
+    return str(value)
+
+
+def format_time(timestamp):
+    t = datetime.datetime.utcfromtimestamp(timestamp)
+    if t.microsecond:
+       return t.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+    return t.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def write_gpx(f, track):
+    '''Write owntracks track (list of points) to file `f` as single segment
+       GPX track, point by point. First and last points are named "Start"
+       and "Finish"'''
+    f.write(HEADER)
+    last = len(track) - 1
+    for idx, p in enumerate(track):
+        chunk = ['\n      <trkpt lat="%s" lon="%s">' % (format_number(p["lat"]), format_number(p["lon"]))]
+        if p.get('alt') is not None:
+           chunk.append('\n        <ele>%s</ele>' % format_number(p['alt']))
+        chunk.append('\n        <time>%s</time>' % format_time(p["tst"]))
+        if idx==0:
+           chunk.append('\n        <name>Start</name>')
+        elif idx==last:
+           chunk.append('\n        <name>Finish</name>')
+        chunk.append('\n      </trkpt>')
+        f.write(''.join(chunk))
+    f.write(FOOTER)
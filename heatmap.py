@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+import os
+import zlib
+import logging
+import argparse
+import numpy
+from PIL import Image
+import tilemap
+import trackdb
+import gpxstream
+from tilemap import TILE_SIZE
+
+DEFAULT_ZOOMS = range(8, 17)
+
+
+def track_pixels(lat, lon, zooms, max_step=1024):
+    '''Pixels crossed by track at every zoom level as {zoom: unique pixel keys},
+       key is x * 2**(zoom+8) + y. Segments longer than `max_step` pixels
+       are gaps in recording and are not drawn'''
+    result = {}
+    if len(lat)==0:
+       return result
+    x0, y0 = tilemap.project(numpy.asarray(lat, dtype=float), numpy.asarray(lon, dtype=float))
+    for zoom in zooms:
+        scale = 2**zoom
+        x = x0 * scale
+        y = y0 * scale
+
+        # sample every segment at least once per pixel
+        dx = numpy.diff(x)
+        dy = numpy.diff(y)
+        steps = numpy.ceil( numpy.maximum(numpy.abs(dx), numpy.abs(dy)) ).astype(numpy.int64)
+        steps[steps > max_step] = 1
+        steps = numpy.maximum(steps, 1)
+        segments = numpy.repeat( numpy.arange(len(steps)), steps )
+        offsets = numpy.cumsum(steps) - steps
+        t = (numpy.arange(len(segments)) - offsets[segments]) / steps[segments].astype(float)
+        px = numpy.append( x[:-1][segments] + t*dx[segments], x[-1] ).astype(numpy.int64)
+        py = numpy.append( y[:-1][segments] + t*dy[segments], y[-1] ).astype(numpy.int64)
+
+        size = scale * TILE_SIZE
+        result[zoom] = numpy.unique( (px % size) * size + numpy.clip(py, 0, size-1) )
+    return result
+
+
+class Heatmap:
+    '''Count of tracks crossing every pixel, per zoom level. Counts are stored
+       in `path` as 256x256 tiles <zoom>/<x>_<y>.tile (zlib compressed uint32 array), adding a track updates
+       only tiles it crosses. Paths of added tracks are listed in `tracks` file
+       so a track is not counted twice'''
+    def __init__(self, path, zooms=None):
+        self.path = path
+        if not os.path.isdir(path):
+           os.makedirs(path)
+
+        zooms_file = os.path.join(path, "zooms")
+        if os.path.exists(zooms_file):
+           with open(zooms_file) as f:
+                self.zooms = [ int(z) for z in f.read().split() ]
+        else:
+           self.zooms = list(zooms or DEFAULT_ZOOMS)
+           with open(zooms_file, "w") as f:
+                f.write( ' '.join(str(z) for z in self.zooms) + '\n' )
+
+        self.tracks = set()
+        tracks_file = os.path.join(path, "tracks")
+        if os.path.exists(tracks_file):
+           with open(tracks_file) as f:
+                self.tracks = set( line.rstrip('\n') for line in f )
+
+    def tile_filename(self, zoom, tx, ty):
+        return os.path.join(self.path, str(zoom), "%d_%d.tile" % (tx, ty))
+
+    def load_tile(self, zoom, tx, ty):
+        filename = self.tile_filename(zoom, tx, ty)
+        if os.path.exists(filename):
+           with open(filename, "rb") as f:
+                return numpy.frombuffer( zlib.decompress(f.read()), dtype=numpy.uint32 ).reshape( (TILE_SIZE, TILE_SIZE) ).copy()
+        return None
+
+    def save_tile(self, zoom, tx, ty, tile):
+        filename = self.tile_filename(zoom, tx, ty)
+        if not os.path.isdir(os.path.dirname(filename)):
+           os.makedirs(os.path.dirname(filename))
+        with open(filename + ".tmp", "wb") as f:
+             f.write( zlib.compress(tile.astype(numpy.uint32).tostring(), 1) )
+        os.rename(filename + ".tmp", filename)
+
+    def add(self, track, pixels):
+        '''Add pixels of track (see track_pixels) to the counts. Returns False if
+           the track was already added'''
+        if track in self.tracks:
+           return False
+        for zoom, keys in pixels.iteritems():
+            if zoom not in self.zooms:
+               continue
+            size = 2**zoom * TILE_SIZE
+            px = keys // size
+            py = keys % size
+            tiles = (px // TILE_SIZE) * 2**zoom + py // TILE_SIZE
+            local = (py % TILE_SIZE) * TILE_SIZE + px % TILE_SIZE
+            order = numpy.argsort(tiles, kind='mergesort')
+            tiles, local = tiles[order], local[order]
+            bounds = numpy.flatnonzero( numpy.diff(tiles) ) + 1
+            for start, end in zip( numpy.append(0, bounds), numpy.append(bounds, len(tiles)) ):
+                tx, ty = divmod( int(tiles[start]), 2**zoom )
+                tile = self.load_tile(zoom, tx, ty)
+                if tile is None:
+                   tile = numpy.zeros( (TILE_SIZE, TILE_SIZE), dtype=numpy.uint32 )
+                tile.ravel()[:] += numpy.bincount( local[start:end], minlength=TILE_SIZE*TILE_SIZE ).astype(numpy.uint32)
+                self.save_tile(zoom, tx, ty, tile)
+        with open(os.path.join(self.path, "tracks"), "a") as f:
+             f.write(track + '\n')
+        self.tracks.add(track)
+        return True
+
+    def tiles(self, zoom):
+        '''List (tx, ty) of stored tiles of zoom level'''
+        directory = os.path.join(self.path, str(zoom))
+        if not os.path.isdir(directory):
+           return []
+        return [ tuple( int(v) for v in os.path.splitext(name)[0].split('_') ) for name in os.listdir(directory) if name.endswith('.tile') ]
+
+    def raster(self, zoom, bbox=None, max_pixels=4096*4096):
+        '''Return (counts, left, top): counts array covering `bbox` (min_lat, min_lon,
+           max_lat, max_lon) or all tracks and world pixel of its top left corner'''
+        if bbox!=None:
+           x, y = tilemap.project( numpy.array([bbox[2], bbox[0]]), numpy.array([bbox[1], bbox[3]]) )
+           left, top = int(x[0] * 2**zoom), int(y[0] * 2**zoom)
+           right, bottom = int(numpy.ceil(x[1] * 2**zoom)), int(numpy.ceil(y[1] * 2**zoom))
+        else:
+           tiles = self.tiles(zoom)
+           if not tiles:
+              return (numpy.zeros( (0, 0), dtype=numpy.uint32 ), 0, 0)
+           left = min( tx for tx, ty in tiles ) * TILE_SIZE
+           top = min( ty for tx, ty in tiles ) * TILE_SIZE
+           right = (max( tx for tx, ty in tiles ) + 1) * TILE_SIZE
+           bottom = (max( ty for tx, ty in tiles ) + 1) * TILE_SIZE
+        if (right-left) * (bottom-top) > max_pixels:
+           raise ValueError("Heatmap of %dx%d pixels is too large, use lower zoom or smaller bbox" % (right-left, bottom-top))
+
+        counts = numpy.zeros( (bottom-top, right-left), dtype=numpy.uint32 )
+        for ty in range(top // TILE_SIZE, (bottom - 1) // TILE_SIZE + 1):
+            for tx in range(left // TILE_SIZE, (right - 1) // TILE_SIZE + 1):
+                tile = self.load_tile(zoom, tx, ty)
+                if tile is None:
+                   continue
+                # part of the tile inside the raster
+                x0, y0 = tx*TILE_SIZE - left, ty*TILE_SIZE - top
+                cx0, cy0 = max(0, -x0), max(0, -y0)
+                cx1, cy1 = min(TILE_SIZE, right - left - x0), min(TILE_SIZE, bottom - top - y0)
+                counts[y0+cy0:y0+cy1, x0+cx0:x0+cx1] = tile[cy0:cy1, cx0:cx1]
+        return (counts, left, top)
+
+    def render(self, zoom, bbox=None, cache=None):
+        '''Render heatmap to Pillow image, over map tiles from `cache` if set'''
+        counts, left, top = self.raster(zoom, bbox)
+        height, width = counts.shape
+        if counts.size==0:
+           raise ValueError("Heatmap is empty at zoom %d" % zoom)
+
+        # logarithmic scale through black-red-yellow-white
+        level = numpy.log1p(counts) / numpy.log1p(max(counts.max(), 1))
+        rgba = numpy.zeros( (height, width, 4), dtype=numpy.uint8 )
+        rgba[...,0] = numpy.clip(level*3, 0, 1) * 255
+        rgba[...,1] = numpy.clip(level*3 - 1, 0, 1) * 255
+        rgba[...,2] = numpy.clip(level*3 - 2, 0, 1) * 255
+        rgba[...,3] = numpy.where( counts > 0, numpy.clip(0.5 + level, 0, 1) * 255, 0 )
+        image = Image.fromarray(rgba, "RGBA")
+
+        if cache!=None:
+           base = tilemap.background(cache, zoom, left, top, width, height).convert("RGBA")
+           base.alpha_composite(image)
+           image = base
+        return image
+
+
+def parse_bbox(string):
+    try:
+       bbox = tuple( float(x) for x in string.split(',') )
+    except ValueError:
+       bbox = ()
+    if len(bbox)!=4:
+       raise argparse.ArgumentTypeError("bbox should be min_lat,min_lon,max_lat,max_lon")
+    return bbox
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser( fromfile_prefix_chars='@', description="Heatmap of all tracks stored by trackrec" )
+   parser.add_argument( "--storage", default="/tmp/" )
+   parser.add_argument( "--heatmap", help="Heatmap directory, default is heatmap in storage" )
+   parser.add_argument( "--zooms", type=lambda s: [ int(z) for z in s.split(',') ], help="Zoom levels of new heatmap, comma separated" )
+   parser.add_argument( "--build", action="store_true", default=False, help="Add tracks from storage which are not in heatmap yet" )
+   parser.add_argument( "--zoom", type=int, default=12, help="Zoom level of rendered image" )
+   parser.add_argument( "--bbox", type=parse_bbox, help="Clip image to box min_lat,min_lon,max_lat,max_lon" )
+   parser.add_argument( "--tiles", metavar="DIR", help="Draw heatmap over map tiles cached in directory" )
+   parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
+   parser.add_argument( "--logfile", help="Logging into file" )
+   parser.add_argument( "output", nargs="?", help="PNG image to render" )
+   args = parser.parse_args()
+
+   logging.basicConfig( format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level= logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
+
+   heatmap = Heatmap( args.heatmap or os.path.join(args.storage, "heatmap"), args.zooms )
+   if args.build:
+      count = 0
+      for name in sorted(os.listdir(args.storage)):
+          if trackdb.TRACK_FILE.match(name)==None or name in heatmap.tracks:
+             continue
+          try:
+             lat, lon, ele, tst = gpxstream.read_arrays( os.path.join(args.storage, name) )
+          except Exception as e:
+             logging.error("Can't read track %s: %s", name, e)
+             continue
+          heatmap.add( name, track_pixels(lat, lon, heatmap.zooms) )
+          count = count + 1
+      logging.info("Added %d tracks to heatmap", count)
+
+   if args.output:
+      cache = tilemap.TileCache(args.tiles) if args.tiles else None
+      heatmap.render( args.zoom, args.bbox, cache ).save( args.output )
+      logging.info("Heatmap saved to %s", args.output)
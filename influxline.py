@@ -0,0 +1,122 @@
+import httplib
+import socket
+import urllib
+import zlib
+import threading
+from math import isnan, isinf
+
+
+class InfluxError(IOError):
+    '''Error response of influxdb with HTTP `status`'''
+    def __init__(self, message, status):
+        IOError.__init__(self, message)
+        self.status = status
+
+
+def rejected(error):
+    '''True if influxdb refused the points themselves (4xx except timeout and
+       rate limit), writing them again won't succeed'''
+    return isinstance(error, InfluxError) and error.status/100==4 and error.status not in (408, 429)
+
+
+def escape_measurement(name):
+    return name.replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_key(name):
+    return name.replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+
+def encode_series(measurement, tags):
+    '''Encode measurement name with tags into series key of line protocol'''
+    return escape_measurement(measurement) + ''.join( ",%s=%s" % (escape_key(k), escape_key(tags[k])) for k in sorted(tags) )
+
+
+def encode_line(measurement, fields, timestamp, tags=None):
+    '''Encode one point into influxdb line protocol.
+       `measurement` should be already escaped (or be a series key made by
+       encode_series), `timestamp` is in nanoseconds. NaN and infinite fields
+       can't be written to influxdb and are dropped, returns None when no
+       field is left'''
+    values = ','.join( "%s=%r" % (escape_key(k), v) for k, v in ( (k, float(v)) for k, v in fields.iteritems() ) if not (isnan(v) or isinf(v)) )
+    if not values:
+       return None
+    line = measurement
+    if tags:
+       line = line + encode_series('', tags)
+    return "%s %s %d" % (line, values, timestamp)
+
+
+class HTTPTransport:
+    '''Write lines to influxdb HTTP API over kept-alive connection,
+       request body is gzip compressed unless `compress` is False'''
+    def __init__(self, host, port=8086, database="home", compress=True, timeout=10):
+        self.host = host
+        self.port = port
+        self.database = database
+        self.compress = compress
+        self.timeout = timeout
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _request(self, path, params, body="", headers={}):
+        with self.lock:
+            if self.conn==None:
+               self.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+               self.conn.request("POST", "%s?%s" % (path, urllib.urlencode(params)), body, headers)
+               response = self.conn.getresponse()
+               data = response.read()
+            except:
+               self.conn.close()
+               self.conn = None
+               raise
+        if response.status/100!=2:
+           raise InfluxError("Influxdb error %d: %s" % (response.status, data), response.status)
+        return data
+
+    def create_database(self):
+        self._request("/query", {'q': 'CREATE DATABASE "%s"' % self.database})
+
+    def write(self, lines):
+        body = '\n'.join(lines) + '\n'
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.compress:
+           packer = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+           body = packer.compress(body) + packer.flush()
+           headers['Content-Encoding'] = 'gzip'
+        self._request("/write", {'db': self.database, 'precision': 'ns'}, body, headers)
+
+    def close(self):
+        with self.lock:
+            if self.conn!=None:
+               self.conn.close()
+               self.conn = None
+
+
+class UDPTransport:
+    '''Send lines to influxdb UDP listener packed into datagrams up to `packet_size` bytes.
+       Database and precision (should be "ns") are set in the listener config'''
+    def __init__(self, host, port=8089, packet_size=1400):
+        self.address = (host, port)
+        self.packet_size = packet_size
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def create_database(self):
+        pass
+
+    def write(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if size+len(line)+1 > self.packet_size and len(packet)>0:
+               self.sock.sendto('\n'.join(packet) + '\n', self.address)
+               packet = []
+               size = 0
+            packet.append(line)
+            size = size + len(line) + 1
+        if len(packet)>0:
+           self.sock.sendto('\n'.join(packet) + '\n', self.address)
+
+    def close(self):
+        self.sock.close()
@@ -2,102 +2,287 @@
 __author__ = "Jan-Piet Mens"
 __copyright__ = "Copyright (C) 2013 by Jan-Piet Mens"
 
-import paho.mqtt.client as paho
 import ssl
-import os, sys
+import sys
 import logging
 import time
 import socket
-import json
-import signal
+import threading
+import collections
+import struct
+import cPickle as pickle
+import random
 import urlparse, argparse
+from mqttbridge import Bridge, Sink
 
 
-client_id = "MQTT2Graphite_%d-%s" % (os.getpid(), socket.getfqdn())
-
-def cleanup(signum, frame):
-    '''Disconnect cleanly on SIGTERM or SIGINT'''
-    mqttc.publish("/clients/" + client_id, "Offline")
-    mqttc.disconnect()
-    logging.info("Disconnected from broker; exiting on signal %d", signum)
-    sys.exit(signum)
-
-
-def is_number(s):
-    '''Test whether string contains a number (leading/traling white-space is ok)'''
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
-
-
-def on_connect(mosq, userdata, rc):
-    logging.info("Connection to broker: %s", paho.connack_string(rc) )
-    if rc==0:
-      mqttc.publish("/clients/" + client_id, "Online")
-
-      map = userdata['map']
-      for topic in map:
-          logging.info("Subscribing to topic %s" % topic)
-          mqttc.subscribe(topic, 0)
-
-def on_message(mosq, userdata, msg):
-
-    sock = userdata['sock']
-    host = userdata['carbon_server']
-    port = userdata['carbon_port']
-    lines = []
-    now = int(time.time())
-
-    map = userdata['map']
-    # Find out how to handle the topic in this message: slurp through
-    # our map 
-    for t in map:
-        if paho.topic_matches_sub(t, msg.topic):
-            # print "%s matches MAP(%s) => %s" % (msg.topic, t, map[t])
-
-            # Must we rename the received msg topic into a different
-            # name for Carbon? In any case, replace MQTT slashes (/)
-            # by Carbon periods (.)
-            (type, remap) = map[t]
-            if remap is None:
-                carbonkey = msg.topic.replace('/', '.')
+class UDPSender:
+    '''Send metrics with carbon plaintext protocol over UDP. Lines of many
+       messages are packed into datagrams up to `packet_size` bytes, incomplete
+       datagram is sent after `interval` ms'''
+    def __init__(self, host, port, packet_size=1400, interval=200):
+        self.address = (host, port)
+        self.packet_size = packet_size
+        self.interval = interval/1000.0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lines = []
+        self.size = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def send(self, metrics):
+        with self.lock:
+            for path, value, timestamp in metrics:
+                line = "%s %f %d\n" % (path, value, timestamp)
+                if self.size+len(line) > self.packet_size:
+                   self._send()
+                self.lines.append(line)
+                self.size = self.size + len(line)
+            if self.lines and self.timer is None:
+               self.timer = threading.Timer(self.interval, self.flush)
+               self.timer.daemon = True
+               self.timer.start()
+
+    def _send(self):
+        lines, self.lines, self.size = self.lines, [], 0
+        if lines:
+           message = ''.join(lines)
+           logging.debug("%s", message.strip())
+           try:
+              self.sock.sendto(message, self.address)
+           except Exception:
+              logging.exception("Error while send data to carbon")
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+               self.timer.cancel()
+               self.timer = None
+            self._send()
+
+    def close(self):
+        self.flush()
+
+
+class PickleSender:
+    '''Send metrics with carbon pickle protocol over persistent TCP connection.
+       Metrics are sent in batches up to `batch` items at least every `interval` ms.
+       While carbon is unreachable up to `max_pending` metrics are kept for retry,
+       the oldest ones are dropped'''
+    def __init__(self, host, port, batch=500, interval=1000, max_pending=100000, retry=5, timeout=10):
+        self.address = (host, port)
+        self.batch = batch
+        self.interval = interval/1000.0
+        self.retry = retry
+        self.timeout = timeout
+        self.sock = None
+        self.failed = 0
+        self.pending = collections.deque(maxlen=max_pending)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.ready = threading.Event()
+
+        thread = threading.Thread(target=self._loop, name="carbon-sender")
+        thread.daemon = True
+        thread.start()
+
+    def send(self, metrics):
+        with self.lock:
+            if len(self.pending)+len(metrics) > self.pending.maxlen:
+               logging.warning("Carbon send buffer is full, dropping %d oldest metrics", len(self.pending)+len(metrics)-self.pending.maxlen)
+            self.pending.extend( (path, (timestamp, value)) for path, value, timestamp in metrics )
+            if len(self.pending)>=self.batch:
+               self.ready.set()
+
+    def _loop(self):
+        while True:
+            self.ready.wait(self.interval)
+            self.ready.clear()
+            if time.time()-self.failed >= self.retry:
+               self.flush()
+
+    def _connect(self):
+        logging.info("Connecting to carbon at %s:%d", *self.address)
+        self.sock = socket.create_connection(self.address, self.timeout)
+
+    def flush(self):
+        with self.send_lock:
+            while True:
+                with self.lock:
+                    batch = [ self.pending.popleft() for i in range(min(self.batch, len(self.pending))) ]
+                if not batch:
+                   return
+                payload = pickle.dumps(batch, protocol=2)
+                try:
+                   if self.sock==None:
+                      self._connect()
+                   self.sock.sendall( struct.pack("!L", len(payload)) + payload )
+                except socket.error as e:
+                   logging.error("Error while send data to carbon: %s; retry in %d seconds", e, self.retry)
+                   if self.sock!=None:
+                      self.sock.close()
+                      self.sock = None
+                   self.failed = time.time()
+                   with self.lock:
+                       # requeue in front of metrics added meanwhile, overflow
+                       # drops the oldest ones
+                       pending = batch + list(self.pending)
+                       if len(pending) > self.pending.maxlen:
+                          logging.warning("Carbon send buffer is full, dropping %d oldest metrics", len(pending)-self.pending.maxlen)
+                       self.pending = collections.deque(pending, maxlen=self.pending.maxlen)
+                   return
+
+    def close(self):
+        self.flush()
+        if self.sock!=None:
+           self.sock.close()
+
+
+class Aggregator:
+    '''Aggregate metrics over windows of `window` seconds (by metric timestamp)
+       and pass count, min, max, mean and last value of every window to sender
+       as path.count, path.min etc. Percentiles are estimated from a random
+       reservoir of up to `reservoir` values. Window is emitted `lag` seconds
+       after it is over, so samples still queued in the bridge make it in time;
+       later samples of an emitted window are dropped, sending a partial window
+       would overwrite the full one in carbon. Without `periodic` windows are
+       emitted only by flush (replay of recorded messages is not in real time)'''
+    def __init__(self, sender, window, percentiles=(), reservoir=128, lag=10, periodic=True):
+        self.sender = sender
+        self.window = window
+        self.percentiles = percentiles
+        self.reservoir = reservoir
+        self.lag = lag
+        # (path, window start) -> [count, min, max, sum, last, reservoir]
+        self.series = {}
+        # path -> start of the last emitted window
+        self.emitted = {}
+        self.late = 0
+        self.lock = threading.Lock()
+
+        if periodic:
+           thread = threading.Thread(target=self._loop, name="carbon-aggregator")
+           thread.daemon = True
+           thread.start()
+
+    def send(self, metrics):
+        with self.lock:
+            for path, value, timestamp in metrics:
+                key = (path, timestamp - timestamp % self.window)
+                stat = self.series.get(key)
+                if stat is None and key[1] <= self.emitted.get(path, -1):
+                   self.late = self.late + 1
+                   continue
+                if stat is None:
+                   self.series[key] = [1, value, value, value, value, [value] if self.percentiles else None]
+                   continue
+                stat[0] = stat[0] + 1
+                if value<stat[1]:
+                   stat[1] = value
+                if value>stat[2]:
+                   stat[2] = value
+                stat[3] = stat[3] + value
+                stat[4] = value
+                if self.percentiles:
+                   if len(stat[5])<self.reservoir:
+                      stat[5].append(value)
+                   else:
+                      idx = random.randint(0, stat[0]-1)
+                      if idx<self.reservoir:
+                         stat[5][idx] = value
+
+    def _loop(self):
+        while True:
+            time.sleep( self.window - (time.time() - self.lag) % self.window )
+            self.flush( int(time.time()) )
+
+    def flush(self, now=None):
+        '''Emit windows which ended `lag` seconds before `now`, all windows if now is None'''
+        with self.lock:
+            if now is None:
+               expired = self.series.keys()
+            else:
+               expired = [ key for key in self.series if key[1]+self.window+self.lag<=now ]
+            stats = [ (key, self.series.pop(key)) for key in expired ]
+            for path, start in expired:
+                if start > self.emitted.get(path, -1):
+                   self.emitted[path] = start
+            late, self.late = self.late, 0
+        if late:
+           logging.warning("Dropped %d samples of already sent aggregation windows, consider larger --aggregate-lag", late)
+
+        metrics = []
+        for (path, timestamp), (count, low, high, total, last, samples) in stats:
+            metrics.append( (path+'.count', count, timestamp) )
+            metrics.append( (path+'.min', low, timestamp) )
+            metrics.append( (path+'.max', high, timestamp) )
+            metrics.append( (path+'.mean', total/count, timestamp) )
+            metrics.append( (path+'.last', last, timestamp) )
+            if samples:
+               samples.sort()
+               for p in self.percentiles:
+                   metrics.append( (path+'.p%g' % p, samples[ int(round(p/100.0*(len(samples)-1))) ], timestamp) )
+        if metrics:
+           self.sender.send(metrics)
+
+    def close(self):
+        self.flush()
+        self.sender.close()
+
+
+class CarbonSink(Sink):
+    '''Send samples to carbon. Scalar payload is stored as carbonkey itself,
+       json fields as carbonkey.field'''
+    name = 'carbon'
+    senders = {'udp': (UDPSender, 2003), 'pickle': (PickleSender, 2004)}
+
+    def __init__(self, sender, **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.sender = sender
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument( "--carbon", default="127.0.0.1", help="Carbon host:port, default port is 2003 for udp and 2004 for pickle" )
+        parser.add_argument( "--carbon-protocol", choices=CarbonSink.senders.keys(), default="udp", help="Plaintext over UDP or pickle over TCP" )
+        parser.add_argument( "--carbon-interval", type=int, default=200, help="Max delay in ms before metrics are sent" )
+        parser.add_argument( "--carbon-batch", type=int, default=500, help="Max metrics in one pickle batch" )
+        parser.add_argument( "--carbon-buffer", type=int, default=100000, help="Max metrics kept while carbon is unreachable" )
+        parser.add_argument( "--aggregate", type=int, default=0, metavar="SECONDS", help="Send count/min/max/mean/last of every metric once per window" )
+        parser.add_argument( "--percentiles", type=lambda x: [float(p) for p in x.split(',')], default=[], help="Comma separated percentiles to send with aggregates, e.g. 50,95" )
+        parser.add_argument( "--reservoir", type=int, default=128, help="Values kept per window to estimate percentiles" )
+        parser.add_argument( "--aggregate-lag", type=int, default=10, metavar="SECONDS", help="Wait for late samples before the window is sent" )
+
+    @classmethod
+    def from_args(cls, args):
+        sender_type, port = cls.senders[args.carbon_protocol]
+        host = parse_host_port(args.carbon, port)
+        try:
+            if sender_type==PickleSender:
+               sender = PickleSender( host[0], host[1], batch=args.carbon_batch, interval=args.carbon_interval, max_pending=args.carbon_buffer )
             else:
-                carbonkey = remap.replace('/', '.')
-            carbonkey=carbonkey.lstrip('.')
+               sender = UDPSender( host[0], host[1], interval=args.carbon_interval )
+        except socket.error:
+            sys.stderr.write("Can't create UDP socket\n")
+            sys.exit(1)
+        if args.aggregate>0:
+           sender = Aggregator( sender, args.aggregate, percentiles=args.percentiles, reservoir=args.reservoir, lag=args.aggregate_lag, periodic=args.replay==None )
+        return cls( sender, workers=args.workers, queue_size=args.queue_size, policy=args.overflow )
 
+    def write(self, samples):
+        metrics = []
+        for carbonkey, fields, now in samples:
             logging.debug("CARBONKEY is [%s]" % carbonkey)
+            now = int(now)
+            for field, value in fields.iteritems():
+                if field is None:
+                    metrics.append( (carbonkey, value, now) )
+                else:
+                    metrics.append( ("%s.%s" % (carbonkey, field), value, now) )
+        self.sender.send(metrics)
 
-            try:
-              # Try to decode data as json
-              st = json.loads(msg.payload)
-              for k in st:
-                  if is_number(st[k]):
-                      lines.append("%s.%s %f %d" % (carbonkey, k, float(st[k]), now))
-            except:
-              # Try to decode as simple number
-              try:
-                  lines.append("%s %f %d" % (carbonkey, float(msg.payload), now))
-              except ValueError:
-                  logging.info("Topic %s contains payload [%s] as unknown data format" % 
-                          (msg.topic, msg.payload))
-                  return
-
-            message = '\n'.join(lines) + '\n'
-            logging.debug("%s", message.strip())
-
-            sock.sendto(message, (host, port))
-  
-def on_subscribe(mosq, userdata, mid, granted_qos):
-    pass
-
-def on_disconnect(mosq, userdata, rc):
-    if rc == 0:
-        logging.info("Clean disconnection")
-    else:
-        logging.info("Unexpected disconnect (%s); reconnecting in 5 seconds", paho.connack_string(rc) )
-        time.sleep(5)
+    def close(self):
+        Sink.close(self)
+        self.sender.close()
 
 def parse_host_port(string, default_port):
     d = string.split(":")
@@ -105,6 +290,10 @@ def parse_host_port(string, default_port):
     port = int(d[1]) if len(d)>1 else default_port 
     return (host,port)
     
+def split_mapping(item):
+    # type topic [-] [carbonkey]
+    return item[1], None if len(item)==2 else item[3]
+
 def main():
     class LoadFromFile( argparse.Action ):
         def __call__ (self, parser, namespace, values, option_string = None):
@@ -115,50 +304,15 @@ def main():
     parser.add_argument( "-c", "--config", type=open, action=LoadFromFile, help="Load config from file" )
     parser.add_argument( "--mqtt", default="localhost:1883", type=urlparse.urlparse )
     parser.add_argument( "--auth" )
-    parser.add_argument( "--carbon", default="127.0.0.1:2003" )
+    CarbonSink.add_arguments(parser)
+    Bridge.add_arguments(parser)
 
-    parser.add_argument( "-m", action="append", nargs="*", dest="map" )
+    parser.add_argument( "-m", action="append", nargs="*", dest="map", help="Mapping: type topic [-] [carbonkey] [abs=N] [rel=N] [heartbeat=SEC]" )
     parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
     parser.add_argument( "--logfile", help="Logging into file" )
     args = parser.parse_args()
 
-    # configure logging
-    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level=logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
-
-    map = {}
-    for item in args.map:
-        type = item[0]
-        topic = item[1]
-        remap = None if len(item)==2 else item[3]
-        map[topic] = (type, remap)
-
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    except:
-        sys.stderr.write("Can't create UDP socket\n")
-        sys.exit(1)
-
-    host = parse_host_port(args.carbon,2003)
-    userdata = {
-        'sock'      : sock,
-        'carbon_server' : host[0],
-        'carbon_port'   : host[1],
-        'map'       : map,
-    }
-    global mqttc
-
-    mqttc = paho.Client(client_id, clean_session=True, userdata=userdata)
-    if args.mqtt.username!=None:
-       mqttc.username_pw_set(args.mqtt.username, args.mqtt.password )
-    mqttc.on_message = on_message
-    mqttc.on_connect = on_connect
-    mqttc.on_disconnect = on_disconnect
-    mqttc.on_subscribe = on_subscribe
-    mqttc.connect(args.mqtt.hostname, 1883 if args.mqtt.port==None else args.mqtt.port , 60)
-
-    signal.signal(signal.SIGTERM, cleanup)
-    signal.signal(signal.SIGINT, cleanup)
-
-    mqttc.loop_forever()
+    Bridge.main( parser, args, lambda args: [CarbonSink.from_args(args)], "MQTT2Graphite", split_mapping )
+
 if __name__ == '__main__':
    main()
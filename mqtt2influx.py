@@ -1,92 +1,216 @@
 #!/usr/bin/python
-import paho.mqtt.client as paho
-import os, sys
+import os
 import logging
 import time
-import socket
-import json
-import signal
+import threading
 import urlparse, argparse
-from influxdb import InfluxDBClient
-
-client_id = "MQTT2Infux_%d-%s" % (os.getpid(), socket.getfqdn())
-
-def cleanup(signum, frame):
-    #mqttc.publish("/clients/" + client_id, "Offline")
-    mqttc.disconnect()
-    logging.info("Disconnected from broker; exiting on signal %d", signum)
-    sys.exit(signum)
-
-
-def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
-
-
-def on_connect(mosq, userdata, rc):
-    logging.info("Connection to broker: %s", paho.connack_string(rc) )
-    if rc==0:
-      mqttc.publish("/clients/" + client_id, "Online")
-
-      map = userdata['map']
-      for topic in map:
-          logging.info("Subscribing to topic %s" % topic)
-          mqttc.subscribe(topic, 0)
-
-
-def on_message(mosq, userdata, msg):
-    client = userdata['client']
-    database = userdata['database']
-    map    = userdata['map']
-
-    lines = []
-    now = int(time.time())
-
-    for t in map:
-        if paho.topic_matches_sub(t, msg.topic):
-            (remap) = map[t]
-            if remap is None:
-                carbonkey = msg.topic.replace('/', '.')
-            else:
-                carbonkey = remap.replace('/', '.')
-            carbonkey=carbonkey.strip('.')
-
-            values={}
-            # try to decode payload as json
+from influxline import HTTPTransport, UDPTransport, encode_line, encode_series, escape_measurement, rejected
+from mqttbridge import Bridge, Sink, LRUCache
+from spool import Spool
+
+class PointsBuffer:
+    '''Collect points encoded in line protocol and write them to influxdb
+       with one request per batch.
+       Batch is flushed when `size` points are collected or `interval` ms passed
+       since the first point in it.
+       If spool is given, batches which can't be written are stored there (as
+       well as all batches during `retry` seconds after a failure) and replayed
+       in background when influxdb is available again. Batches rejected by
+       influxdb with 4xx error are logged and dropped, retrying them won't help'''
+    def __init__(self, transport, size=100, interval=1000, spool=None, retry=30):
+        self.transport = transport
+        self.size = size
+        self.interval = interval/1000.0
+        self.points = []
+        self.timer = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+        self.spool = spool
+        self.retry = retry
+        self.failed = 0
+        if spool!=None:
+            thread = threading.Thread(target=self._replay, name="spool-replay")
+            thread.daemon = True
+            thread.start()
+
+    def add(self, points):
+        with self.lock:
+            self.points.extend(points)
+            if len(self.points) < self.size:
+                if self.timer is None:
+                    self.timer = threading.Timer(self.interval, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def write(self, lines):
+        self.transport.write(lines)
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            lines, self.points = self.points, []
+        if len(lines)==0:
+            return
+
+        with self.write_lock:
+            if self.spool!=None and time.time()-self.failed < self.retry:
+               logging.debug("Influxdb is unavailable, spool %d points", len(lines))
+               self.spool.append(lines)
+               return
+
+            logging.debug("Write %d points to influx", len(lines))
             try:
-              st = json.loads(msg.payload)
-              for k in st:
-                  if is_number(st[k]):
-                     values[k] = float(st[k])
-            except:
-              # Try to decode payload as number
-              try:
-                  values['value'] = float(msg.payload)
-              except ValueError:
-                  logging.debug("Topic %s contains payload [%s] as unknown data format" %  (msg.topic, msg.payload))
+               self.write(lines)
+            except Exception as e:
+               if rejected(e):
+                  logging.error("Influxdb rejected %d points: %s", len(lines), e)
                   return
-
-            points=[ {'measurement': carbonkey, 'fields': values } ]
-            logging.debug(  "Write to influx %s", json.dumps(points, indent=2) )
-            try:
-               client.write_points( points, database=database )
-            except:
                logging.exception("Error while write data to influxdb")
+               if self.spool!=None:
+                  self.failed = time.time()
+                  self.spool.append(lines)
+
+    def _replay(self):
+        while True:
+            time.sleep(1)
+            self.spool.sync()
+            if not self.spool.pending() or time.time()-self.failed < self.retry:
+               continue
+            if not self.spool.replay(self.write, rejected=rejected):
+               self.failed = time.time()
+
+    def close(self):
+        self.flush()
+        if self.spool!=None:
+           self.spool.close()
+        self.transport.close()
+
+
+class Template:
+    '''Split metric key (topic with / replaced by .) into measurement name and tags.
+       Template is a topic pattern like /home/sensor/{room}/{kind}, where {name}
+       level becomes tag `name`, {measurement} and literal levels make measurement
+       name, + level is skipped and trailing # adds remaining levels to the name'''
+    def __init__(self, template):
+        self.template = template
+        self.levels = template.replace('/', '.').strip('.').split('.')
+        if '#' in self.levels[:-1]:
+           raise ValueError("# must be the last level of template %s" % template)
+
+    def match(self, levels):
+        '''Return (measurement, tags) or None if levels don't match the template'''
+        if self.levels[-1]=='#':
+           if len(levels)<len(self.levels)-1:
+              return None
+        elif len(levels)!=len(self.levels):
+           return None
+
+        measurement = []
+        tags = {}
+        for idx, level in enumerate(self.levels):
+            if level=='#':
+               measurement.extend(levels[idx:])
+               break
+            value = levels[idx]
+            if level=='+':
+               continue
+            if level.startswith('{') and level.endswith('}'):
+               if level=='{measurement}':
+                  measurement.append(value)
+               else:
+                  tags[level[1:-1]] = value
+            elif level!=value:
+               return None
+            else:
+               measurement.append(value)
+        if not measurement:
+           return None
+        return ('.'.join(measurement), tags)
+
+
+class InfluxSink(Sink):
+    '''Write samples to influxdb, measurement is the metric key or is made from
+       it by the first matching template'''
+    name = 'influx'
+
+    def __init__(self, writer, templates=[], **kwargs):
+        Sink.__init__(self, **kwargs)
+        self.writer = writer
+        self.templates = templates
+        self.series = LRUCache(4096)
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument( "--influx", default="localhost:8086", help="Influxdb host:port" )
+        parser.add_argument( "--transport", choices=["http", "udp"], default="http", help="Write points over HTTP API or to UDP listener" )
+        parser.add_argument( "--no-gzip", action="store_false", default=True, dest="gzip", help="Don't compress HTTP requests" )
+        parser.add_argument( "--database", default="home" )
+        parser.add_argument( "--batch-size", type=int, default=100, help="Max points in one write request" )
+        parser.add_argument( "--flush-interval", type=int, default=1000, help="Max delay in ms before points are written" )
+        parser.add_argument( "--timeout", type=int, default=10, help="Influxdb request timeout in seconds" )
+        parser.add_argument( "--spool", help="Directory for points which can't be written to influxdb" )
+        parser.add_argument( "--spool-segment", type=int, default=4, help="Spool segment size in Mb" )
+        parser.add_argument( "--spool-max", type=int, default=256, help="Max spool size in Mb" )
+        parser.add_argument( "--spool-sync", type=int, default=5, help="Interval between spool fsync in seconds" )
+        parser.add_argument( "--retry-interval", type=int, default=30, help="Seconds before retry write to influxdb after failure" )
+        parser.add_argument( "--template", action="append", default=[], dest="templates", help="Topic template to make measurement and tags, e.g. /home/sensor/{room}/{kind}" )
+
+    @classmethod
+    def from_args(cls, args):
+        if args.transport=="udp":
+           host = parse_host_port(args.influx, 8089)
+           transport = UDPTransport( host[0], host[1] )
+        else:
+           host = parse_host_port(args.influx, 8086)
+           transport = HTTPTransport( host[0], host[1], database=args.database, compress=args.gzip, timeout=args.timeout )
+        try:
+          transport.create_database()
+        except:
+           logging.exception('Create database error')
+
+        spool = None
+        if args.spool!=None:
+           # every bridge instance needs its own spool
+           path = args.spool if args.instances<=1 else os.path.join(args.spool, str(args.instance))
+           spool = Spool( path, segment_size=args.spool_segment*1024*1024, max_size=args.spool_max*1024*1024, sync_interval=args.spool_sync )
+
+        writer = PointsBuffer( transport, size=args.batch_size, interval=args.flush_interval, spool=spool, retry=args.retry_interval )
+        return cls( writer, templates=[ Template(x) for x in args.templates ], workers=args.workers, queue_size=args.queue_size, policy=args.overflow )
+
+    def series_key(self, key):
+        series = self.series.get(key)
+        if series is None:
+           series = escape_measurement(key)
+           levels = key.split('.')
+           for template in self.templates:
+               match = template.match(levels)
+               if match!=None:
+                  series = encode_series(*match)
+                  break
+           self.series.put(key, series)
+        return series
+
+    def write(self, samples):
+        lines = []
+        for key, fields, now in samples:
+            if None in fields:
+               fields = {'value': fields[None]}
+            line = encode_line(self.series_key(key), fields, int(now*1000000000))
+            if line!=None:
+               lines.append(line)
+            else:
+               logging.debug("Skip %s without finite values", key)
+        self.writer.add( lines )
 
- 
-def on_subscribe(mosq, userdata, mid, granted_qos):
-    pass
-
+    def close(self):
+        Sink.close(self)
+        self.writer.close()
 
-def on_disconnect(mosq, userdata, rc):
-    if rc == 0:
-        logging.info("Clean disconnection")
-    else:
-        logging.info("Unexpected disconnect (%s); reconnecting in 5 seconds", paho.connack_string(rc) )
-        time.sleep(5)
 
 def parse_host_port(string, default_port):
     d = string.split(":")
@@ -103,49 +227,16 @@ def main():
     parser = argparse.ArgumentParser( fromfile_prefix_chars='@' )
     parser.add_argument( "-c", "--config", type=open, action=LoadFromFile, help="Load config from file" )
     parser.add_argument( "--mqtt", default="localhost:1883", type=urlparse.urlparse )
-    parser.add_argument( "--database", default="home" )
     parser.add_argument( "--auth" )
+    InfluxSink.add_arguments(parser)
+    Bridge.add_arguments(parser)
 
-    parser.add_argument( "-m", action="append", nargs="*", dest="map" )
+    parser.add_argument( "-m", action="append", nargs="*", dest="map", help="Mapping: topic [measurement] [abs=N] [rel=N] [heartbeat=SEC]" )
     parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
     parser.add_argument( "--logfile", help="Logging into file" )
     args = parser.parse_args()
 
-    # configure logging
-    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level=logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
-
-    map = {}
-    for item in args.map:
-        topic = item[0]
-        remap = None if len(item)==1 else item[1]
-        map[topic] = (remap)
-
-    influx_client = InfluxDBClient(host='localhost',port=8086, database=args.database)
-    try:
-      influx_client.create_database(args.database)
-    except:
-       logging.exception('Create database error')
-    userdata = {
-        'client' : influx_client,
-        'database': args.database,
-        'map'    : map,
-    }
-    influx_client.switch_database(args.database)
-    global mqttc
-
-    mqttc = paho.Client(client_id, clean_session=True, userdata=userdata)
-    if args.mqtt.username!=None:
-       mqttc.username_pw_set(args.mqtt.username, args.mqtt.password )
-    mqttc.on_message = on_message
-    mqttc.on_connect = on_connect
-    mqttc.on_disconnect = on_disconnect
-    mqttc.on_subscribe = on_subscribe
-    mqttc.connect(args.mqtt.hostname, 1883 if args.mqtt.port==None else args.mqtt.port , 60)
-
-    signal.signal(signal.SIGTERM, cleanup)
-    signal.signal(signal.SIGINT, cleanup)
-
-    mqttc.loop_forever()
+    Bridge.main( parser, args, lambda args: [InfluxSink.from_args(args)], "MQTT2Infux" )
 
 if __name__ == '__main__':
    main()
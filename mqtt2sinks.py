@@ -0,0 +1,34 @@
+#!/usr/bin/python
+import urlparse, argparse
+from mqttbridge import Bridge
+from mqtt2influx import InfluxSink
+from mqtt2carbon import CarbonSink
+
+sink_types = { x.name: x for x in [InfluxSink, CarbonSink] }
+
+def main():
+    class LoadFromFile( argparse.Action ):
+        def __call__ (self, parser, namespace, values, option_string = None):
+           with values as f:
+               parser.parse_args(f.read().split(), namespace)
+
+    parser = argparse.ArgumentParser( fromfile_prefix_chars='@' )
+    parser.add_argument( "-c", "--config", type=open, action=LoadFromFile, help="Load config from file" )
+    parser.add_argument( "--mqtt", default="localhost:1883", type=urlparse.urlparse )
+    parser.add_argument( "--auth" )
+    parser.add_argument( "--sink", action="append", choices=sink_types.keys(), dest="sinks", help="Enabled sinks" )
+    for name in sink_types:
+        sink_types[name].add_arguments(parser)
+    Bridge.add_arguments(parser)
+
+    parser.add_argument( "-m", action="append", nargs="*", dest="map", help="Mapping: topic [key] [abs=N] [rel=N] [heartbeat=SEC]" )
+    parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
+    parser.add_argument( "--logfile", help="Logging into file" )
+    args = parser.parse_args()
+    if not args.sinks:
+       parser.error("At least one --sink is required")
+
+    Bridge.main( parser, args, lambda args: [ sink_types[name].from_args(args) for name in set(args.sinks) ], "MQTT2Sinks" )
+
+if __name__ == '__main__':
+   main()
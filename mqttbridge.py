@@ -0,0 +1,679 @@
+import paho.mqtt.client as paho
+import os, sys
+import logging
+import time
+import signal
+import socket
+import threading
+import Queue
+import json
+import struct
+import gzip
+import zlib
+
+
+class WorkQueue:
+    '''Bounded queue between MQTT network thread and a pool of worker threads.
+       When the queue is full new item is handled according to overflow policy:
+         block       - wait for a free slot (stalls MQTT client loop)
+         drop-oldest - discard the oldest queued item
+         drop-newest - discard the item being added'''
+    policies = ('block', 'drop-oldest', 'drop-newest')
+
+    def __init__(self, handler, workers=1, size=1000, policy='drop-oldest'):
+        if policy not in self.policies:
+           raise ValueError("Unknown overflow policy %s" % policy)
+        self.handler = handler
+        self.policy = policy
+        self.queue = Queue.Queue(size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker, name="worker-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        if self.policy=='block':
+           self.queue.put(item)
+           return
+
+        while True:
+            try:
+               self.queue.put_nowait(item)
+               return
+            except Queue.Full:
+               if self.policy=='drop-newest':
+                  self._dropped()
+                  return
+            try:
+               self.queue.get_nowait()
+               self.queue.task_done()
+               self._dropped()
+            except Queue.Empty:
+               pass
+
+    def _dropped(self):
+        with self.lock:
+            self.dropped = self.dropped + 1
+            dropped = self.dropped
+        if dropped==1 or dropped % 1000==0:
+           logging.warning("Work queue is full (policy %s), %d messages dropped", self.policy, dropped)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+               self.handler(item)
+            except:
+               logging.exception("Error while process queued message")
+            finally:
+               self.queue.task_done()
+
+    def join(self):
+        '''Wait until all queued items are processed'''
+        self.queue.join()
+
+
+class LRUCache:
+    '''Approximate LRU cache made of two generations. When the current generation
+       is full it becomes the old one, entries of the old generation are moved
+       back on use and the rest are dropped on next rotation. Lookups are plain
+       dict reads, so the cache is cheap to use from several threads'''
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def get(self, key):
+        value = self.current.get(key)
+        if value is None:
+           value = self.old.get(key)
+           if value is not None:
+              self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if len(self.current)>=self.size:
+           self.old = self.current
+           self.current = {}
+        self.current[key] = value
+
+    def clear(self):
+        self.current = {}
+        self.old = {}
+
+
+class TopicNode:
+    __slots__ = ('children', 'values', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.values = []
+        self.wildcard = []
+
+
+class TopicRouter:
+    '''Index of subscription patterns (with + and # wildcards) stored as a trie
+       over topic levels. Concrete topic is resolved once by calling
+       `resolve(topic, pattern, value)` for every matching pattern, result is kept
+       in LRU cache so routing cost does not depend on number of patterns'''
+    def __init__(self, resolve=None, cache_size=4096):
+        self.root = TopicNode()
+        self.count = 0
+        self.resolve = resolve if resolve!=None else (lambda topic, pattern, value: value)
+        self.cache = LRUCache(cache_size)
+
+    def add(self, pattern, value):
+        node = self.root
+        item = (self.count, pattern, value)
+        self.count = self.count + 1
+
+        levels = pattern.split('/')
+        for idx, level in enumerate(levels):
+            if level=='#' and idx==len(levels)-1:
+               node.wildcard.append(item)
+               break
+            node = node.children.setdefault(level, TopicNode())
+        else:
+            node.values.append(item)
+
+        self.cache.clear()
+
+    def match(self, topic):
+        '''Return (pattern, value) for all patterns matching topic in order they were added'''
+        levels = topic.split('/')
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, idx = stack.pop()
+            # "a/#" matches "a" too
+            found.extend(node.wildcard)
+            if idx==len(levels):
+               found.extend(node.values)
+               continue
+            child = node.children.get(levels[idx])
+            if child!=None:
+               stack.append((child, idx+1))
+            child = node.children.get('+')
+            if child!=None:
+               stack.append((child, idx+1))
+        found.sort()
+        return [(pattern, value) for order, pattern, value in found]
+
+    def route(self, topic):
+        '''Return tuple of resolved routes for the topic'''
+        routes = self.cache.get(topic)
+        if routes is None:
+           routes = tuple( self.resolve(topic, pattern, value) for pattern, value in self.match(topic) )
+           self.cache.put(topic, routes)
+        return routes
+
+
+def is_number(value):
+    try:
+       float(value)
+    except (ValueError, TypeError):
+       return False
+    return True
+
+
+class PayloadDecoder:
+    '''Extract numeric fields from MQTT payloads.
+       Shape of the payload (scalar, flat or nested json object) is learned on the
+       first message of a topic and an extractor for exactly this shape is cached.
+       Nested keys are flattened into dotted field names. When extractor fails
+       (the shape has changed: keys of any object differ, or a key skipped as
+       non-numeric gets a number or an object) the shape is learned again'''
+    def __init__(self, scalar_field='value', cache_size=4096):
+        self.scalar_field = scalar_field
+        self.cache = LRUCache(cache_size)
+
+    def decode(self, topic, payload):
+        '''Return dict of field values or None if payload has unknown format'''
+        extractor = self.cache.get(topic)
+        if extractor!=None:
+           try:
+              return extractor(payload)
+           except (ValueError, TypeError, KeyError):
+              logging.debug("Payload shape of topic %s has changed", topic)
+
+        extractor = self.learn(payload)
+        if extractor==None:
+           return None
+        self.cache.put(topic, extractor)
+        return extractor(payload)
+
+    def learn(self, payload):
+        try:
+           data = json.loads(payload)
+        except ValueError:
+           data = None
+
+        if not isinstance(data, dict):
+           try:
+              float(payload)
+           except ValueError:
+              return None
+           return self.scalar_extractor()
+
+        fields = []
+        skipped = []
+        # size of every object on the way to the fields
+        nodes = []
+        stack = [((), data)]
+        while stack:
+            path, node = stack.pop()
+            nodes.append( (path, len(node)) )
+            for key, value in node.iteritems():
+                if isinstance(value, dict):
+                   stack.append( (path+(key,), value) )
+                   continue
+                if not is_number(value):
+                   skipped.append(path+(key,))
+                   continue
+                fields.append( (path+(key,), '.'.join(path+(key,)).encode('utf-8')) )
+
+        if len(nodes)>1:
+           return self.nested_extractor(fields, skipped, nodes)
+        return self.flat_extractor([ (path[0], name) for path, name in fields ], [ path[0] for path in skipped ], len(data))
+
+    def scalar_extractor(self):
+        field = self.scalar_field
+        def extract(payload):
+            return {field: float(payload)}
+        return extract
+
+    def flat_extractor(self, fields, skipped, size):
+        loads = json.loads
+        def extract(payload):
+            data = loads(payload)
+            if len(data)!=size:
+               raise KeyError("Keys of payload have changed")
+            for key in skipped:
+                value = data[key]
+                if isinstance(value, dict) or is_number(value):
+                   raise KeyError("Key %s has got a value to extract" % key)
+            return dict( (name, float(data[key])) for key, name in fields )
+        return extract
+
+    def nested_extractor(self, fields, skipped, nodes):
+        loads = json.loads
+        def lookup(data, path):
+            for key in path:
+                data = data[key]
+            return data
+        def extract(payload):
+            data = loads(payload)
+            for path, size in nodes:
+                if len(lookup(data, path))!=size:
+                   raise KeyError("Keys of %s have changed" % ('.'.join(path) or 'payload'))
+            for path in skipped:
+                value = lookup(data, path)
+                if isinstance(value, dict) or is_number(value):
+                   raise KeyError("Key %s has got a value to extract" % '.'.join(path))
+            return dict( (name, float(lookup(data, path))) for path, name in fields )
+        return extract
+
+
+def parse_mapping(item):
+    '''Split arguments of -m into positional ones and key=value options'''
+    args = [ x for x in item if '=' not in x ]
+    options = dict( x.split('=', 1) for x in item if '=' in x )
+    return args, options
+
+
+class Deadband:
+    '''Drop values which did not change since last forwarded value of the series by
+       more than `absolute` or `relative` (fraction of last value) threshold. Without
+       thresholds any change is forwarded. Value is forwarded anyway when `heartbeat`
+       seconds passed since last forwarded one'''
+    options = ('abs', 'rel', 'heartbeat')
+
+    def __init__(self, absolute=None, relative=None, heartbeat=None):
+        if absolute==None and relative==None:
+           absolute = 0.0
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+        # series -> (last forwarded value, time)
+        self.table = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_options(cls, options):
+        '''Make deadband filter from mapping options or return None if it is not configured'''
+        unknown = [ x for x in options if x not in cls.options ]
+        if unknown:
+           raise ValueError("Unknown mapping options: %s" % ', '.join(unknown))
+        if not options:
+           return None
+        return cls( absolute=float(options['abs']) if 'abs' in options else None,
+                    relative=float(options['rel']) if 'rel' in options else None,
+                    heartbeat=float(options['heartbeat']) if 'heartbeat' in options else None )
+
+    def changed(self, last, value):
+        delta = abs(value-last)
+        if self.absolute!=None and delta>self.absolute:
+           return True
+        if self.relative!=None and delta>abs(last)*self.relative:
+           return True
+        return False
+
+    def filter(self, key, values, now):
+        '''Return fields of values which should be forwarded, `now` is in seconds'''
+        result = {}
+        with self.lock:
+            for field, value in values.iteritems():
+                series = (key, field)
+                last = self.table.get(series)
+                if last!=None and not self.changed(last[0], value):
+                   if self.heartbeat==None or now-last[1] < self.heartbeat:
+                      continue
+                self.table[series] = (value, now)
+                result[field] = value
+        return result
+
+
+class Capture:
+    '''Append-only file of received messages. Every record is a header (receive
+       time as double, topic length, payload length) followed by topic and payload.
+       Files with .gz suffix are gzip compressed'''
+    header = struct.Struct('<dHI')
+
+    def __init__(self, filename):
+        if filename.endswith('.gz'):
+           self.file = gzip.open(filename, 'ab')
+        else:
+           self.file = open(filename, 'ab', 65536)
+
+    def write(self, now, topic, payload):
+        if isinstance(topic, unicode):
+           topic = topic.encode('utf-8')
+        self.file.write( self.header.pack(now, len(topic), len(payload)) + topic + payload )
+
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def read(cls, filename, chunk_size=1024*1024):
+        '''Yield (time, topic, payload) records, incomplete last record is ignored'''
+        f = gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
+        size = cls.header.size
+        unpack = cls.header.unpack_from
+        buf = ''
+        pos = 0
+        try:
+           while True:
+               data = f.read(chunk_size)
+               if not data:
+                  break
+               buf = buf[pos:] + data
+               pos = 0
+               end = len(buf)
+               while pos+size <= end:
+                   now, topic_len, payload_len = unpack(buf, pos)
+                   start = pos + size
+                   stop = start + topic_len + payload_len
+                   if stop > end:
+                      break
+                   yield now, buf[start:start+topic_len], buf[start+topic_len:stop]
+                   pos = stop
+        finally:
+           f.close()
+
+
+def instance_filename(filename, instance, instances):
+    '''Name of file written by one of `instances` bridge processes: <file>.<instance>,
+       the index goes before .gz suffix. Single instance uses `filename` as is'''
+    if filename==None or instances<=1:
+       return filename
+    if filename.endswith('.gz'):
+       return "%s.%d.gz" % (filename[:-3], instance)
+    return "%s.%d" % (filename, instance)
+
+
+class Sink:
+    '''Output of the bridge. Samples reach the sink through its own bounded queue
+       and writer threads, so slow or failing sink does not stall the others.
+       Subclasses define `write(samples)`, it is called by writer threads with list
+       of (key, fields, timestamp) samples. Key is dotted metric name, fields maps
+       field name (None for scalar payload) to value, timestamp is receive time
+       in seconds'''
+    name = None
+
+    def __init__(self, workers=1, queue_size=1000, policy='drop-oldest'):
+        self.queue = WorkQueue(self.write, workers=workers, size=queue_size, policy=policy)
+
+    def put(self, samples):
+        self.queue.put(samples)
+
+    def close(self):
+        self.queue.join()
+
+
+def supervise(instances, delay=5):
+    '''Fork `instances` bridge processes and restart them when they exit.
+       Returns index of the instance in child processes (0 if only one instance
+       is requested and nothing is forked), supervisor process never returns'''
+    if instances<=1:
+       return 0
+
+    children = {}
+    def spawn(index):
+        pid = os.fork()
+        if pid==0:
+           signal.signal(signal.SIGTERM, signal.SIG_DFL)
+           signal.signal(signal.SIGINT, signal.SIG_DFL)
+           return True
+        children[pid] = index
+        logging.info("Started bridge instance %d (pid %d)", index, pid)
+        return False
+
+    def terminate(signum, frame):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in children:
+            try:
+               os.kill(pid, signal.SIGTERM)
+               os.waitpid(pid, 0)
+            except OSError:
+               pass
+        logging.info("Bridge instances stopped; exiting on signal %d", signum)
+        sys.exit(signum)
+
+    for index in range(instances):
+        if spawn(index):
+           return index
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index==None:
+           continue
+        logging.warning("Bridge instance %d (pid %d) exited with status %d; restarting in %d seconds", index, pid, status>>8, delay)
+        time.sleep(delay)
+        if spawn(index):
+           return index
+
+
+def fork_workers(count):
+    '''Fork `count` processes sharing one job. Returns index of the process in
+       children (0 if `count` is 1 and nothing is forked), parent waits for all
+       children and exits, with status 1 if any of them failed'''
+    if count<=1:
+       return 0
+
+    children = {}
+    for index in range(count):
+        pid = os.fork()
+        if pid==0:
+           return index
+        children[pid] = index
+
+    failed = 0
+    while children:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index!=None and status!=0:
+           logging.error("Worker process %d (pid %d) exited with status %d", index, pid, status>>8)
+           failed = failed + 1
+    sys.exit(1 if failed else 0)
+
+
+class Bridge:
+    '''Subscribe to mapped topics once, decode every message once and fan
+       resulting samples out to all sinks.
+       With `share` group topics are subscribed as MQTT shared subscriptions
+       ($share/<group>/<topic>), so the broker balances messages between
+       all bridges of the group'''
+    def __init__(self, client_id, sinks, queue_size=1000, policy='drop-oldest', share=None, mqtt5=False, capture=None):
+        self.client_id = client_id
+        self.sinks = sinks
+        self.share = share
+        self.capture = Capture(capture) if capture!=None else None
+        self.topics = []
+        self.router = TopicRouter(self.resolve)
+        self.decoder = PayloadDecoder(scalar_field=None)
+        self.queue = WorkQueue(self.process, size=queue_size, policy=policy)
+
+        if mqtt5:
+           if not hasattr(paho, 'MQTTv5'):
+              raise ValueError("MQTT 5 is not supported by installed paho-mqtt")
+           self.mqttc = paho.Client(client_id, protocol=paho.MQTTv5)
+        else:
+           self.mqttc = paho.Client(client_id, clean_session=True)
+        self.mqttc.on_connect = self.on_connect
+        self.mqttc.on_message = self.on_message
+        self.mqttc.on_disconnect = self.on_disconnect
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument( "--workers", type=int, default=1, help="Number of writer threads per sink" )
+        parser.add_argument( "--queue-size", type=int, default=1000, help="Max messages waiting for processing" )
+        parser.add_argument( "--overflow", choices=WorkQueue.policies, default="drop-oldest", help="What to do when queue is full" )
+        parser.add_argument( "--share", metavar="GROUP", help="Use shared subscriptions of the group" )
+        parser.add_argument( "--mqtt5", action="store_true", default=False, help="Connect with MQTT 5 protocol" )
+        parser.add_argument( "--instances", type=int, default=1, help="Number of bridge processes to run (requires --share)" )
+        parser.add_argument( "--capture", metavar="FILE", help="Record received messages to file, every instance writes its own FILE.<instance>" )
+        parser.add_argument( "--replay", metavar="FILE", nargs="+", help="Process recorded messages instead of connecting to broker" )
+        parser.add_argument( "--replay-processes", type=int, default=1, metavar="N",
+                             help="Split replay by topic between N processes, one process handles 25-45k messages/s. "
+                                  "Topics remapped to the same key should be replayed with one process" )
+
+    def add_mapping(self, topic, remap=None, deadband=None):
+        self.topics.append(topic)
+        self.router.add(topic, (remap, deadband))
+
+    def resolve(self, topic, pattern, value):
+        # Replace MQTT slashes (/) by periods (.) in topic or in its remapped name
+        (remap, deadband) = value
+        key = topic if remap is None else remap
+        # paho gives unicode topics, sinks write byte strings
+        if isinstance(key, unicode):
+           key = key.encode('utf-8')
+        return (key.replace('/', '.').strip('.'), deadband)
+
+    def connect(self, url):
+        if url.username!=None:
+           self.mqttc.username_pw_set(url.username, url.password)
+        self.mqttc.connect(url.hostname, 1883 if url.port==None else url.port, 60)
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        logging.info("Connection to broker: %s", paho.connack_string(rc) )
+        if rc==0:
+           client.publish("/clients/" + self.client_id, "Online")
+           for topic in self.topics:
+               if self.share!=None:
+                  topic = "$share/%s/%s" % (self.share, topic)
+               logging.info("Subscribing to topic %s" % topic)
+               client.subscribe(topic, 0)
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        if rc == 0:
+           logging.info("Clean disconnection")
+        else:
+           logging.info("Unexpected disconnect (%s); reconnecting in 5 seconds", paho.connack_string(rc) )
+           time.sleep(5)
+
+    def on_message(self, client, userdata, msg):
+        now = time.time()
+        if self.capture!=None:
+           self.capture.write(now, msg.topic, msg.payload)
+        self.queue.put( (now, msg) )
+
+    def decode(self, now, topic, payload):
+        '''Return list of samples produced by the message'''
+        routes = self.router.route(topic)
+        if len(routes)==0:
+           return []
+
+        values = self.decoder.decode(topic, payload)
+        if not values:
+           logging.debug("Topic %s contains payload [%s] as unknown data format", topic, payload)
+           return []
+
+        samples = []
+        for key, deadband in routes:
+            fields = values if deadband is None else deadband.filter(key, values, now)
+            if fields:
+               samples.append( (key, fields, now) )
+        return samples
+
+    def process(self, item):
+        now, msg = item
+        samples = self.decode(now, msg.topic, msg.payload)
+        if samples:
+           for sink in self.sinks:
+               sink.put(samples)
+
+    def replay(self, filenames, batch=1000, part=0, parts=1):
+        '''Pass recorded messages through routing, decoding and sinks as fast as
+           sinks accept them, original receive times are kept. With `parts` > 1
+           only topics of part number `part` (by topic hash) are replayed, so
+           messages of a topic stay in order within one process'''
+        started = time.time()
+        count = 0
+        samples = []
+        for filename in filenames:
+            logging.info("Replaying %s", filename)
+            for now, topic, payload in Capture.read(filename):
+                if parts>1 and (zlib.crc32(topic) & 0xffffffff) % parts!=part:
+                   continue
+                samples.extend( self.decode(now, topic, payload) )
+                count = count + 1
+                if len(samples)>=batch:
+                   for sink in self.sinks:
+                       sink.put(samples)
+                   samples = []
+        if samples:
+           for sink in self.sinks:
+               sink.put(samples)
+        for sink in self.sinks:
+            sink.close()
+
+        elapsed = max(time.time()-started, 0.001)
+        logging.info("Replayed %d messages in %.1f seconds (%d messages/s)", count, elapsed, count/elapsed)
+
+    @classmethod
+    def main(cls, parser, args, make_sinks, client_prefix, split_mapping=None):
+        '''Start bridge script: configure logging, fork instances, create sinks
+           with `make_sinks(args)` in every instance, add -m mappings and either
+           replay captured messages or run connected to the broker.
+           `split_mapping(item)` returns (topic, remap) of mapping arguments,
+           default layout is topic [key]'''
+        logging.basicConfig(format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level=logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
+
+        if args.instances>1 and args.share==None:
+           parser.error("--instances requires --share")
+        if args.replay!=None:
+           # sinks must not drop samples while replaying at full speed
+           args.overflow = "block"
+           args.instances = args.replay_processes
+           args.instance = fork_workers(args.replay_processes)
+        else:
+           args.instance = supervise(args.instances)
+        client_id = "%s_%d-%s" % (client_prefix, os.getpid(), socket.getfqdn())
+
+        bridge = cls( client_id, make_sinks(args), queue_size=args.queue_size, policy=args.overflow, share=args.share, mqtt5=args.mqtt5, capture=instance_filename(args.capture, args.instance, args.instances) )
+        for item in args.map or []:
+            item, options = parse_mapping(item)
+            if split_mapping!=None:
+               topic, remap = split_mapping(item)
+            else:
+               topic, remap = item[0], None if len(item)==1 else item[1]
+            try:
+               deadband = Deadband.from_options(options)
+            except ValueError as e:
+               parser.error(str(e))
+            bridge.add_mapping(topic, remap, deadband)
+
+        if args.replay!=None:
+           bridge.replay(args.replay, part=args.instance, parts=args.instances)
+        else:
+           bridge.connect(args.mqtt)
+           bridge.run()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.cleanup)
+        signal.signal(signal.SIGINT, self.cleanup)
+        self.mqttc.loop_forever()
+
+    def stop(self):
+        self.mqttc.publish("/clients/" + self.client_id, "Offline")
+        self.mqttc.disconnect()
+        self.queue.join()
+        if self.capture!=None:
+           self.capture.close()
+        for sink in self.sinks:
+            sink.close()
+
+    def cleanup(self, signum, frame):
+        '''Disconnect cleanly on SIGTERM or SIGINT'''
+        self.stop()
+        logging.info("Disconnected from broker; exiting on signal %d", signum)
+        sys.exit(signum)
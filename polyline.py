@@ -0,0 +1,126 @@
+import numpy
+import math
+from trackstats import ONE_DEGREE
+
+
+def project(lat, lon):
+    '''Project coordinates to meters on a plane touching the track middle'''
+    coef = math.cos(math.radians((lat.min() + lat.max()) / 2))
+    return (lon - lon[0]) * coef * ONE_DEGREE, (lat - lat[0]) * ONE_DEGREE
+
+
+def importance(lat, lon, tolerance=0):
+    '''Douglas-Peucker significance of every point in meters: simplification
+       with tolerance t keeps points with importance > t, endpoints are inf.
+       Ranges not deviating more than `tolerance` are not split further,
+       their points get 0. Iterative, all ranges of one split level are
+       processed at once'''
+    size = len(lat)
+    result = numpy.zeros(size)
+    if size==0:
+       return result
+    result[0] = result[-1] = numpy.inf
+    x, y = project(lat, lon)
+
+    first = numpy.array([0])
+    last = numpy.array([size-1])
+    limit = numpy.array([numpy.inf])
+    while True:
+        keep = last - first >= 2
+        first, last, limit = first[keep], last[keep], limit[keep]
+        if len(first)==0:
+           return result
+
+        # interior points of all ranges, `ranges` maps them to their range
+        counts = last - first - 1
+        offsets = numpy.cumsum(counts) - counts
+        ranges = numpy.repeat(numpy.arange(len(first)), counts)
+        start = first[ranges]
+        points = numpy.arange(len(ranges)) - offsets[ranges] + start + 1
+
+        # distance to the segment between range ends
+        dx = (x[last] - x[first])[ranges]
+        dy = (y[last] - y[first])[ranges]
+        px = x[points] - x[start]
+        py = y[points] - y[start]
+        length = dx*dx + dy*dy
+        t = numpy.clip( (px*dx + py*dy) / numpy.where(length > 0, length, 1), 0, 1 )
+        px = px - t*dx
+        py = py - t*dy
+        dist = px*px + py*py
+
+        # first farthest point of every range
+        peak = numpy.maximum.reduceat(dist, offsets)
+        candidates = numpy.flatnonzero( dist == peak[ranges] )
+        unused, idx = numpy.unique(ranges[candidates], return_index=True)
+        middle = points[candidates[idx]]
+        deviation = numpy.sqrt(peak)
+
+        split = deviation > tolerance
+        middle = middle[split]
+        # point can't outlive the split which made it
+        deviation = numpy.minimum(deviation[split], limit[split])
+        result[middle] = deviation
+
+        first, last = numpy.concatenate( (first[split], middle) ), numpy.concatenate( (middle, last[split]) )
+        limit = numpy.concatenate( (deviation, deviation) )
+
+
+def simplify(lat, lon, tolerance):
+    '''Return indexes of points kept by Douglas-Peucker with `tolerance` meters'''
+    return numpy.flatnonzero( importance(lat, lon, tolerance) > tolerance )
+
+
+def most_important(significance, count):
+    '''Return indexes (in track order) of `count` most important points'''
+    if count >= len(significance):
+       return numpy.arange(len(significance))
+    return numpy.sort( numpy.argsort(-significance, kind='mergesort')[:count] )
+
+
+def fit(significance, count, size_of, max_size):
+    '''Find the largest number of most important points (up to `count`) for which
+       `size_of(indexes)` is not over `max_size`, return their indexes'''
+    low, high = min(2, count), count
+    best = most_important(significance, low)
+    if size_of(most_important(significance, high)) <= max_size:
+       return most_important(significance, high)
+    while high - low > 1:
+        middle = (low + high) // 2
+        indexes = most_important(significance, middle)
+        if size_of(indexes) <= max_size:
+           low, best = middle, indexes
+        else:
+           high = middle
+    return best
+
+
+def encode(lat, lon, precision=5):
+    '''Encode coordinates with Google polyline algorithm in one vectorized pass.
+       Coordinates are truncated to `precision` decimal digits'''
+    if len(lat)==0:
+       return ''
+    scale = 10**precision
+    values = numpy.column_stack( ((lat*scale).astype(numpy.int64), (lon*scale).astype(numpy.int64)) )
+    values = numpy.diff(values, axis=0, prepend=0).ravel()
+    values = numpy.where(values < 0, ~(values << 1), values << 1)
+
+    # 5 bit chunks, lowest first, all but last have continuation bit
+    chunks = (values[:,None] >> numpy.arange(0, 35, 5)) & 0x1f
+    count = 1 + ( (values[:,None] >> numpy.arange(5, 35, 5)) > 0 ).sum(axis=1)
+    index = numpy.arange(7)
+    chunks = chunks + 63 + 0x20 * (index < count[:,None]-1)
+    return chunks[index < count[:,None]].astype(numpy.uint8).tostring()
+
+
+def track_bounds(lat, lon):
+    '''Start, end and bounding box of track as dict of lat_start, lon_start,
+       lat_end, lon_end, lat_min, lon_min, lat_max, lon_max'''
+    if len(lat)==0:
+       return dict.fromkeys( ('lat_start', 'lon_start', 'lat_end', 'lon_end', 'lat_min', 'lon_min', 'lat_max', 'lon_max') )
+    return {
+       'lat_start': float(lat[0]), 'lon_start': float(lon[0]),
+       'lat_end': float(lat[-1]), 'lon_end': float(lon[-1]),
+       'lat_min': float(lat.min()), 'lon_min': float(lon.min()),
+       'lat_max': float(lat.max()), 'lon_max': float(lon.max())
+    }
@@ -0,0 +1,145 @@
+import os
+import time
+import logging
+import threading
+
+
+class SendError(Exception):
+    '''Sending of replayed records failed, the error is already logged'''
+
+
+class Spool:
+    '''Append-only on-disk queue of text records (one record per line).
+       Records are appended to the current segment file, the segment is rotated
+       when it grows over `segment_size` bytes. When total size exceeds `max_size`
+       the oldest segments are discarded. Data is flushed to OS on every append,
+       fsync is issued at most once per `sync_interval` seconds.
+
+       Segment is removed only when all its records were sent, so after a failure
+       in the middle of a segment some records can be replayed twice'''
+    suffix = '.spool'
+
+    def __init__(self, path, segment_size=4*1024*1024, max_size=256*1024*1024, sync_interval=5):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(path):
+           os.makedirs(path)
+
+        self.segments = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(self.suffix):
+               filename = os.path.join(path, name)
+               self.segments.append( [filename, os.path.getsize(filename)] )
+        self.seq = int(os.path.basename(self.segments[-1][0])[:-len(self.suffix)]) if self.segments else 0
+        self.current = None
+        self.synced = time.time()
+        if self.segments:
+           logging.info("Spool %s contains %d bytes in %d segments", path, self.size(), len(self.segments))
+
+    def size(self):
+        return sum( size for filename, size in self.segments )
+
+    def pending(self):
+        return len(self.segments)>0
+
+    def _open(self):
+        self.seq = self.seq + 1
+        filename = os.path.join(self.path, "%016d%s" % (self.seq, self.suffix))
+        self.current = open(filename, 'ab')
+        self.segments.append( [filename, 0] )
+
+    def _close(self):
+        if self.current!=None:
+           self.current.flush()
+           os.fsync(self.current.fileno())
+           self.current.close()
+           self.current = None
+           self.synced = time.time()
+
+    def _remove(self, filename):
+        try:
+           os.remove(filename)
+        except OSError:
+           pass
+        self.segments = [ s for s in self.segments if s[0]!=filename ]
+
+    def append(self, records):
+        if len(records)==0:
+           return
+        data = '\n'.join(records) + '\n'
+        with self.lock:
+            if self.current==None:
+               self._open()
+            self.current.write(data)
+            self.current.flush()
+            self.segments[-1][1] = self.segments[-1][1] + len(data)
+
+            if self.segments[-1][1] >= self.segment_size:
+               self._close()
+            elif time.time()-self.synced >= self.sync_interval:
+               os.fsync(self.current.fileno())
+               self.synced = time.time()
+
+            while self.size()>self.max_size and len(self.segments)>1:
+               filename, size = self.segments[0]
+               logging.warning("Spool is full, discarding segment %s (%d bytes)", filename, size)
+               self._remove(filename)
+
+    def sync(self):
+        with self.lock:
+            if self.current!=None and time.time()-self.synced >= self.sync_interval:
+               os.fsync(self.current.fileno())
+               self.synced = time.time()
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def replay(self, send, batch=5000, rejected=None):
+        '''Send spooled records with `send(records)` oldest first, in batches of
+           `batch` records. Returns False if sending failed. Batches failed with
+           an error for which `rejected(error)` is true can never be sent, they
+           are logged and dropped instead of blocking the spool'''
+        with self.lock:
+            self._close()
+            segments = [ filename for filename, size in self.segments ]
+
+        def send_batch(records):
+            try:
+               send(records)
+            except Exception as e:
+               if rejected==None or not rejected(e):
+                  logging.exception("Error while replay spool segment %s", filename)
+                  raise SendError()
+               logging.error("Dropped %d spooled records from %s rejected by receiver: %s", len(records), filename, e)
+               return 0
+            return len(records)
+
+        for filename in segments:
+            count = 0
+            try:
+               records = []
+               with open(filename, 'rb') as f:
+                    for line in f:
+                        # incomplete tail of a segment written before crash
+                        if not line.endswith('\n'):
+                           break
+                        records.append(line[:-1])
+                        if len(records)>=batch:
+                           count = count + send_batch(records)
+                           records = []
+               if len(records)>0:
+                  count = count + send_batch(records)
+            except SendError:
+               return False
+            except IOError:
+               logging.exception("Error while read spool segment %s", filename)
+
+            logging.info("Replayed %d records from spool segment %s", count, filename)
+            with self.lock:
+                self._remove(filename)
+        return True
@@ -0,0 +1,133 @@
+import random
+import calendar
+import datetime
+import unittest
+import StringIO
+import gpxpy.gpx
+import trackstats
+import gpxstream
+
+
+def random_track(size, seed, far=False, alt=True, zeros=False, stops=True):
+    '''Owntracks track of `size` points: random walk with stops (repeated points),
+       optional jumps over 0.5 degree and missing or zero elevations'''
+    r = random.Random(seed)
+    lat, lon, tst = 55.7 + r.random(), 37.6 + r.random(), 1500000000
+    track = []
+    for i in range(size):
+        p = { 'lat': lat, 'lon': lon, 'tst': tst }
+        if alt:
+           p['alt'] = 0 if zeros and r.random() < .3 else r.randint(100, 140)
+        if r.random() < .5:
+           p['vel'] = r.randint(0, 90)
+        track.append(p)
+        step = 0 if stops and r.random() < .2 else r.random() * 0.002
+        if far and r.random() < .05:
+           step = .5
+        lat = lat + step * r.choice([-1, 1])
+        lon = lon + step * r.choice([-1, 1])
+        tst = tst + r.randint(0, 30)
+    return track
+
+
+def track2gpx(track):
+    gpx = gpxpy.gpx.GPX()
+    gpx_track = gpxpy.gpx.GPXTrack()
+    gpx.tracks.append(gpx_track)
+    gpx_segment = gpxpy.gpx.GPXTrackSegment()
+    gpx_track.segments.append(gpx_segment)
+    for idx, p in enumerate(track):
+        gpx_segment.points.append( gpxpy.gpx.GPXTrackPoint(
+             p["lat"], p["lon"], elevation=p.get('alt'), time=datetime.datetime.utcfromtimestamp(p["tst"]), speed=p.get('vel'),
+             name="Start" if idx==0 else ( "Finish" if idx==len(track)-1 else None ) ) )
+    return gpx
+
+
+def gpxpy_stat(track):
+    '''Track statistics calculated with gpxpy the way trackrec did before trackstats'''
+    gpx = track2gpx(track)
+    start_time = None
+    end_time = None
+    for point in gpx.get_points_data():
+        if point.point.time:
+           if start_time==None and point.distance_from_start>0:
+              start_time = point.point.time
+           end_time = point.point.time
+    if start_time==None:
+       start_time = end_time
+    move_data = gpx.get_moving_data()
+    move_time = (end_time - start_time).total_seconds()
+    return {
+       'start_time': calendar.timegm(start_time.utctimetuple()),
+       'end_time': calendar.timegm(end_time.utctimetuple()),
+       'move_time': move_time,
+       'avg_speed': (move_data.moving_distance / move_time * 3.6) if move_time!=0 else 0,
+       'max_speed': move_data.max_speed * 3.6,
+       'distance': move_data.moving_distance / 1000
+    }
+
+
+class TrackStatParity(unittest.TestCase):
+    '''trackstats must publish the same statistics as gpxpy did'''
+    variants = [ {}, {'far': True}, {'alt': False}, {'zeros': True}, {'stops': False} ]
+    # max speed needs at least 20 points, shorter tracks report 0
+    sizes = [ 1, 2, 5, 19, 20, 21, 50, 300 ]
+
+    def assertClose(self, expected, actual, message):
+        self.assertTrue( abs(expected - actual) <= 1e-9 * max(1., abs(expected)), "%s: %r != %r" % (message, expected, actual) )
+
+    def check(self, track, message):
+        expected = gpxpy_stat(track)
+        actual = trackstats.track_stat(track)
+        for key in ('start_time', 'end_time', 'move_time', 'avg_speed', 'max_speed', 'distance'):
+            self.assertClose( expected[key], actual[key], "%s %s" % (message, key) )
+
+    def test_random_tracks(self):
+        for seed in range(300):
+            for variant in self.variants:
+                size = random.Random(seed).choice(self.sizes)
+                self.check( random_track(size, seed, **variant), "seed %d, %d points, %r" % (seed, size, variant) )
+
+    def test_short_tracks(self):
+        for size in self.sizes[:5]:
+            for variant in self.variants:
+                self.check( random_track(size, size, **variant), "%d points, %r" % (size, variant) )
+
+    def test_standing_track(self):
+        track = [ {'lat': 55.75, 'lon': 37.61, 'alt': 120, 'tst': 1500000000 + i*10} for i in range(30) ]
+        self.check( track, "standing track" )
+        self.assertEqual( trackstats.track_stat(track)['start_time'], track[-1]['tst'] )
+
+    def test_bounds(self):
+        track = random_track(100, 1, far=True)
+        self.assertEqual( trackstats.track_stat(track)['bounds'],
+                          ( min(p['lat'] for p in track), min(p['lon'] for p in track), max(p['lat'] for p in track), max(p['lon'] for p in track) ) )
+
+
+class WriteGPXParity(unittest.TestCase):
+    '''gpxstream must store tracks byte for byte as gpxpy did'''
+    def check(self, track, message):
+        f = StringIO.StringIO()
+        gpxstream.write_gpx(f, track)
+        self.assertEqual( track2gpx(track).to_xml(), f.getvalue(), message )
+
+    def test_random_tracks(self):
+        for seed in range(100):
+            for variant in TrackStatParity.variants:
+                self.check( random_track(seed % 40 + 1, seed, **variant), "seed %d, %r" % (seed, variant) )
+
+    def test_fractional_time(self):
+        track = random_track(30, 1)
+        for p in track:
+            p['tst'] = p['tst'] + 0.25
+        self.check( track, "fractional time" )
+
+    def test_extreme_coordinates(self):
+        # tiny values must not be written in scientific notation
+        track = [ {'lat': 1e-07, 'lon': -2.5e-05, 'alt': 1e-06, 'tst': 1500000000},
+                  {'lat': -89.999999, 'lon': 179.123456789, 'alt': -12.5, 'tst': 1500000007} ]
+        self.check( track, "extreme coordinates" )
+
+
+if __name__ == "__main__":
+   unittest.main()
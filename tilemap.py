@@ -0,0 +1,161 @@
+import os
+import math
+import shutil
+import logging
+import urllib2
+import collections
+import numpy
+from PIL import Image, ImageDraw
+
+TILE_SIZE = 256
+
+
+class TileCache:
+    '''On-disk cache of map tiles stored as <path>/<z>/<x>/<y>.png. Total size
+       is kept under `max_size` bytes by removing least recently used tiles,
+       use time is kept in file mtime so it survives restarts. Missing tiles
+       are downloaded from `url` template ({z}, {x}, {y}) if it is set'''
+    def __init__(self, path, max_size=256*1024*1024, url=None, timeout=10):
+        self.path = path
+        self.max_size = max_size
+        self.url = url
+        self.timeout = timeout
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+
+        found = []
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if name.endswith('.png'):
+                   filename = os.path.join(root, name)
+                   st = os.stat(filename)
+                   found.append( (st.st_mtime, filename, st.st_size) )
+        for mtime, filename, size in sorted(found):
+            self.tiles[filename] = size
+            self.size = self.size + size
+        self._evict()
+
+    def filename(self, z, x, y):
+        return os.path.join(self.path, str(z), str(x), "%d.png" % y)
+
+    def _evict(self):
+        while self.size > self.max_size and self.tiles:
+            filename, size = self.tiles.popitem(last=False)
+            self.size = self.size - size
+            try:
+               os.remove(filename)
+            except OSError:
+               pass
+
+    def _add(self, filename, size):
+        self.size = self.size - self.tiles.pop(filename, 0) + size
+        self.tiles[filename] = size
+        self._evict()
+
+    def put(self, z, x, y, data):
+        filename = self.filename(z, x, y)
+        if not os.path.isdir(os.path.dirname(filename)):
+           os.makedirs(os.path.dirname(filename))
+        with open(filename + ".tmp", "wb") as f:
+             f.write(data)
+        os.rename(filename + ".tmp", filename)
+        self._add(filename, len(data))
+
+    def get(self, z, x, y):
+        '''Return tile image or None if it is not cached and can't be downloaded'''
+        filename = self.filename(z, x, y)
+        if filename in self.tiles:
+           try:
+              image = Image.open(filename)
+              image.load()
+              os.utime(filename, None)
+              self.tiles[filename] = self.tiles.pop(filename)
+              return image
+           except (IOError, OSError):
+              # evicted by other process or broken
+              self.size = self.size - self.tiles.pop(filename)
+        if self.url==None:
+           return None
+        url = self.url.format(z=z, x=x, y=y)
+        try:
+           req = urllib2.Request(url, headers={'User-Agent': 'track2img'})
+           self.put(z, x, y, urllib2.urlopen(req, timeout=self.timeout).read())
+           image = Image.open(filename)
+           image.load()
+           return image
+        except (IOError, OSError) as e:
+           logging.warning("Can't download tile %s: %s", url, e)
+           return None
+
+    def seed(self, directory):
+        '''Copy tiles laid out as <z>/<x>/<y>.png from `directory` into the cache'''
+        count = 0
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                parts = os.path.relpath(os.path.join(root, name), directory).split(os.sep)
+                if len(parts)!=3 or not name.endswith('.png'):
+                   continue
+                try:
+                   z, x, y = int(parts[0]), int(parts[1]), int(name[:-4])
+                except ValueError:
+                   continue
+                filename = self.filename(z, x, y)
+                if not os.path.isdir(os.path.dirname(filename)):
+                   os.makedirs(os.path.dirname(filename))
+                shutil.copyfile(os.path.join(root, name), filename)
+                self._add(filename, os.path.getsize(filename))
+                count = count + 1
+        logging.info("Seeded %d tiles from %s", count, directory)
+        return count
+
+
+def project(lat, lon):
+    '''Web Mercator coordinates of zoom level 0 in pixels'''
+    lat = numpy.clip(lat, -85.0511, 85.0511)
+    x = (lon + 180.) / 360. * TILE_SIZE
+    y = (1 - numpy.log(numpy.tan(numpy.radians(lat)) + 1 / numpy.cos(numpy.radians(lat))) / math.pi) / 2 * TILE_SIZE
+    return x, y
+
+
+def fit_zoom(x, y, width, height, margin=20, max_zoom=17):
+    '''Largest zoom level at which the track fits into the image'''
+    scale = min( (width - 2*margin) / max(x.max() - x.min(), 1e-12), (height - 2*margin) / max(y.max() - y.min(), 1e-12) )
+    return int( max(0, min(max_zoom, math.floor(math.log(scale, 2)))) )
+
+
+def background(cache, zoom, left, top, width, height):
+    '''Map image of `width` x `height` pixels starting at world pixel (`left`, `top`)
+       of `zoom` level, missing tiles are left gray'''
+    scale = 2**zoom
+    image = Image.new("RGB", (width, height), (224, 224, 224))
+    for ty in range(top // TILE_SIZE, (top + height - 1) // TILE_SIZE + 1):
+        if ty < 0 or ty >= scale:
+           continue
+        for tx in range(left // TILE_SIZE, (left + width - 1) // TILE_SIZE + 1):
+            tile = cache.get(zoom, tx % scale, ty) if cache!=None else None
+            if tile!=None:
+               image.paste( tile.convert("RGB"), (tx*TILE_SIZE - left, ty*TILE_SIZE - top) )
+    return image
+
+
+def render(lat, lon, cache, width=640, height=480, zoom=None, color=(0, 0, 255), line_width=3):
+    '''Draw track over map tiles from `cache`, returns Pillow image'''
+    x, y = project(lat, lon)
+    if zoom==None:
+       zoom = fit_zoom(x, y, width, height)
+    scale = 2**zoom
+    x = x * scale
+    y = y * scale
+
+    # pixel of the world map at the top left corner of the image
+    left = int( (x.min() + x.max()) / 2 - width / 2 )
+    top = int( (y.min() + y.max()) / 2 - height / 2 )
+
+    image = background(cache, zoom, left, top, width, height)
+    draw = ImageDraw.Draw(image)
+    points = numpy.column_stack( (x - left, y - top) )
+    if len(points) > 1:
+       draw.line( [ tuple(p) for p in points.tolist() ], fill=color, width=line_width, joint="curve" )
+    for (px, py), marker in ( (points[0], (0, 160, 0)), (points[-1], (200, 0, 0)) ):
+        draw.ellipse( (px-6, py-6, px+6, py+6), fill=marker, outline=(255, 255, 255) )
+    return image
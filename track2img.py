@@ -1,83 +1,142 @@
 import logging
-import gpxpy
-from gpxpy.gpx import TimeBounds
 import argparse
 import urllib2
+import os
+import signal
+import multiprocessing
+import numpy
+import polyline
+import gpxstream
+import tilemap
 
-def encodeNumber(num):
-    num = num << 1
-    if num < 0:
-      num = ~num
-    encoded = ''
-    while num >= 0x20:
-       encoded = encoded + chr( (0x20 | (num & 0x1f)) + 63)
-       num = num >> 5
-    return encoded + chr(num + 63)
-
-def display_gpx(gpx, namespace):
-    namespace.lat_start = None
-    namespace.lon_start = None
-
-    namespace.lat_end = None
-    namespace.lon_end = None
-
-    namespace.lat_min = None
-    namespace.lon_min = None
-
-    namespace.lat_max = None
-    namespace.lon_max = None
-
-    encoded = ''
-    oldLat = 0
-    oldLon = 0
-
-    for tr in gpx.tracks:
-        for seg in tr.segments:
-            for p in seg.points:
-                if namespace.lat_min==None or namespace.lat_min>p.latitude: 
-                   namespace.lat_min = p.latitude
-                if namespace.lat_max==None or namespace.lat_max<p.latitude: 
-                   namespace.lat_max = p.latitude
-                if namespace.lon_min==None or namespace.lon_min>p.longitude: 
-                   namespace.lon_min = p.longitude
-                if namespace.lon_max==None or namespace.lon_max<p.longitude: 
-                   namespace.lon_max = p.longitude
-
-                if namespace.lat_start==None:
-                   namespace.lat_start = p.latitude
-                   namespace.lon_start = p.longitude
-
-                namespace.lat_end = p.latitude
-                namespace.lon_end = p.longitude
-
-                ecenter='%f,%f' % (p.latitude, p.longitude )
-                lat = int( p.latitude * 100000 )
-                lon = int( p.longitude * 100000 )
-                encoded = encoded + encodeNumber( lat - oldLat ) + encodeNumber(lon - oldLon)
-                oldLat = lat
-                oldLon = lon
-                pass
-    namespace.shape = encoded
+def display_gpx(lat, lon, namespace):
+    vars(namespace).update( polyline.track_bounds(lat, lon) )
+
+    def url_length(indexes):
+        namespace.shape = polyline.encode( lat[indexes], lon[indexes] )
+        return len( format_url(namespace) )
+
+    tolerance = getattr(namespace, 'tolerance', 0)
+    max_url_length = getattr(namespace, 'max_url_length', None)
+    if tolerance or max_url_length:
+       significance = polyline.importance( lat, lon, tolerance )
+       indexes = numpy.flatnonzero( significance > tolerance )
+       if max_url_length:
+          indexes = polyline.fit( significance, len(indexes), url_length, max_url_length )
+          if url_length(indexes) > max_url_length:
+             logging.warning("Track doesn't fit into %d characters of URL", max_url_length)
+       logging.info("Track simplified from %d to %d points", len(lat), len(indexes))
+    else:
+       indexes = slice(None)
+    namespace.shape = polyline.encode( lat[indexes], lon[indexes] )
+
+
+def format_url(namespace):
+    return namespace.url.format( **{x[0]:x[1] for x in namespace._get_kwargs() } )
+
+
+# tile cache of the process, batch workers open their own
+tile_caches = {}
+
+def tile_cache(namespace):
+    if namespace.tiles not in tile_caches:
+       tile_caches[namespace.tiles] = tilemap.TileCache( namespace.tiles, namespace.tile_cache_size*1024*1024, namespace.tile_url )
+    return tile_caches[namespace.tiles]
+
+
+def render_track(gpx_file, output, namespace):
+    lat, lon, ele, tst = gpxstream.read_arrays(gpx_file)
+
+    if namespace.tiles:
+       if len(lat)==0:
+          raise ValueError("track has no points")
+       width, height = namespace.size
+       tilemap.render( lat, lon, tile_cache(namespace), width, height ).save( output )
+       logging.info("Track image saved to %s", output)
+       return
+
+    display_gpx(lat, lon, namespace)
+
+    url = format_url(namespace)
+    logging.info( url )
+    req = urllib2.urlopen( url )
+    f = open(output,"wb")
+    f.write( req.read() )
+    f.close()
+    logging.info("Track image saved to %s", output)
+
+
+def render_job(job):
+    '''Render one track in batch worker process, returns error or None'''
+    gpx_file, output, namespace = job
+    try:
+       render_track(gpx_file, output, namespace)
+    except Exception as e:
+       logging.error("Can't render %s: %s", gpx_file, e)
+       return "%s: %s" % (gpx_file, e)
+
+
+def parse_size(string):
+    try:
+       width, height = [ int(x) for x in string.split('x') ]
+    except ValueError:
+       raise argparse.ArgumentTypeError("size should be WIDTHxHEIGHT")
+    return (width, height)
+
+
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def batch_jobs(namespace):
+    '''Tracks of batch directory without up to date image'''
+    output_dir = namespace.output_dir or namespace.batch
+    for name in sorted(os.listdir(namespace.batch)):
+        for suffix in ('.gpx', '.gpx.gz'):
+            if name.endswith(suffix):
+               gpx_file = os.path.join(namespace.batch, name)
+               output = os.path.join(output_dir, name[:-len(suffix)] + ".png")
+               if namespace.force or not os.path.exists(output) or os.path.getmtime(output) < os.path.getmtime(gpx_file):
+                  yield (gpx_file, output, namespace)
 
 
 if __name__ == "__main__":
    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-   parser.add_argument( "--url", required=True )
+   parser.add_argument( "--url", help="Static map URL template, image is downloaded from it" )
+   parser.add_argument( "--tiles", metavar="DIR", help="Render image locally over map tiles cached in directory" )
+   parser.add_argument( "--tile-url", help="Tile server URL template ({z}, {x}, {y}) for tiles missing in cache" )
+   parser.add_argument( "--tile-cache-size", type=int, default=256, help="Tile cache size limit in MB" )
+   parser.add_argument( "--seed-tiles", metavar="DIR", help="Copy tiles laid out as z/x/y.png from directory into cache" )
+   parser.add_argument( "--size", type=parse_size, default=(640, 480), help="Image size for local rendering: WIDTHxHEIGHT" )
+   parser.add_argument( "--tolerance", type=float, default=0, help="Simplify track, drop points closer than this number of meters to the shape" )
+   parser.add_argument( "--max-url-length", type=int, help="Simplify track until image URL fits into this number of characters" )
+   parser.add_argument( "--batch", metavar="DIR", help="Render all GPX files of directory which have no up to date image" )
+   parser.add_argument( "--output-dir", help="Directory for images in batch mode, default is the GPX files directory" )
+   parser.add_argument( "--processes", type=int, default=None, help="Number of batch workers, default is number of CPUs" )
+   parser.add_argument( "--force", action="store_true", default=False, help="Render images of all tracks in batch mode" )
    parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
    parser.add_argument( "--logfile", help="Logging into file" )
-   parser.add_argument( "gpx_file" )
-   parser.add_argument( "output", default="track.png" )
+   parser.add_argument( "gpx_file", nargs="?" )
+   parser.add_argument( "output", nargs="?", default="track.png" )
    args = parser.parse_args()
 
    logging.basicConfig( format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level= logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
 
-   gpx = gpxpy.parse( open(args.gpx_file,"r") )
-   display_gpx(gpx, args)
+   if args.url==None and args.tiles==None:
+      parser.error("--url or --tiles is required")
+   if args.seed_tiles:
+      if args.tiles==None:
+         parser.error("--seed-tiles needs --tiles")
+      tile_cache(args).seed(args.seed_tiles)
 
-   url = args.url.format( **{x[0]:x[1] for x in args._get_kwargs() } )
-   logging.info( url )
-   req = urllib2.urlopen( url )
-   f = open(args.output,"wb")
-   f.write( req.read() )
-   f.close()
-   logging.info("Track image saved to %s", args.output)
+   if args.batch:
+      pool = multiprocessing.Pool( args.processes, init_worker )
+      errors = [ e for e in pool.imap_unordered( render_job, batch_jobs(args) ) if e!=None ]
+      pool.close()
+      pool.join()
+      if errors:
+         logging.error("%d tracks failed", len(errors))
+   elif args.gpx_file:
+      render_track(args.gpx_file, args.output, args)
+   elif not args.seed_tiles:
+      parser.error("gpx_file or --batch is required")
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+import os
+import json
+import re
+import time
+import calendar
+import datetime
+import logging
+import argparse
+import sqlite3
+import trackstats
+import gpxstream
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    device TEXT NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    distance REAL
+);
+CREATE INDEX IF NOT EXISTS tracks_device_time ON tracks (device, start_time);
+CREATE INDEX IF NOT EXISTS tracks_time ON tracks (start_time);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_bbox USING rtree (id, min_lat, max_lat, min_lon, max_lon);
+CREATE TABLE IF NOT EXISTS odometer_log (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    device TEXT NOT NULL,
+    tracker TEXT,
+    path TEXT,
+    odo REAL NOT NULL,
+    engine_time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    id INTEGER PRIMARY KEY,
+    digest BLOB UNIQUE NOT NULL,
+    time REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS odometer (
+    device TEXT PRIMARY KEY,
+    odo REAL NOT NULL,
+    engine_time REAL NOT NULL
+);
+'''
+
+# <device>-<YYYY_mm_dd-HH_MM>.gpx[.gz] as stored by trackrec
+TRACK_FILE = re.compile(r'^(.+)-(\d{4}_\d\d_\d\d-\d\d_\d\d)\.gpx(\.gz)?$')
+
+
+class TrackCatalog:
+    '''SQLite catalog of stored tracks: device, time bounds (unix time), distance (km)
+       and bounding box kept in R-tree index. Paths are relative to the storage.
+
+       Also keeps device odometers: every track adds a row with its distance (km)
+       and engine time (hours) to odometer_log and updates the totals in one
+       transaction, so totals can be recomputed from the log. Digests of processed
+       track payloads are kept to detect resent tracks'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def add(self, path, device, start_time, end_time, distance, bounds):
+        with self.db:
+            cursor = self.db.execute('SELECT id FROM tracks WHERE path=?', (path,))
+            row = cursor.fetchone()
+            if row!=None:
+               self.db.execute('DELETE FROM tracks_bbox WHERE id=?', row)
+               self.db.execute('DELETE FROM tracks WHERE id=?', row)
+            cursor = self.db.execute('INSERT INTO tracks (path, device, start_time, end_time, distance) VALUES (?,?,?,?,?)',
+                                     (path, device, start_time, end_time, distance))
+            if bounds!=None:
+               min_lat, min_lon, max_lat, max_lon = bounds
+               self.db.execute('INSERT INTO tracks_bbox (id, min_lat, max_lat, min_lon, max_lon) VALUES (?,?,?,?,?)',
+                               (cursor.lastrowid, min_lat, max_lat, min_lon, max_lon))
+
+    def paths(self):
+        return set( row[0] for row in self.db.execute('SELECT path FROM tracks') )
+
+    def query(self, device=None, since=None, until=None, bbox=None):
+        '''Return (path, device, start_time, end_time, distance) of tracks of `device`
+           overlapping [since, until] time range and crossing `bbox`
+           (min_lat, min_lon, max_lat, max_lon) ordered by start time'''
+        sql = 'SELECT t.path, t.device, t.start_time, t.end_time, t.distance FROM tracks t'
+        where = []
+        params = []
+        if bbox!=None:
+           sql = sql + ' JOIN tracks_bbox b ON b.id=t.id'
+           where.append('b.max_lat>=? AND b.min_lat<=? AND b.max_lon>=? AND b.min_lon<=?')
+           params.extend( (bbox[0], bbox[2], bbox[1], bbox[3]) )
+        if device!=None:
+           where.append('t.device=?')
+           params.append(device)
+        if since!=None:
+           where.append('t.end_time>=?')
+           params.append(since)
+        if until!=None:
+           where.append('t.start_time<=?')
+           params.append(until)
+        if where:
+           sql = sql + ' WHERE ' + ' AND '.join(where)
+        return self.db.execute(sql + ' ORDER BY t.start_time', params).fetchall()
+
+    def has_upload(self, digest):
+        return self.db.execute('SELECT 1 FROM uploads WHERE digest=?', (sqlite3.Binary(digest),)).fetchone()!=None
+
+    def _add_upload(self, digest, max_size):
+        self.db.execute('INSERT OR IGNORE INTO uploads (digest, time) VALUES (?,?)', (sqlite3.Binary(digest), time.time()))
+        self.db.execute('DELETE FROM uploads WHERE id <= (SELECT MAX(id) FROM uploads) - ?', (max_size,))
+
+    def add_upload(self, digest, max_size):
+        '''Remember digest of processed track payload, only `max_size` latest are kept'''
+        with self.db:
+            self._add_upload(digest, max_size)
+
+    def _add_counters(self, device, tracker, path, odo, engine_time, now):
+        self.db.execute('INSERT INTO odometer_log (time, device, tracker, path, odo, engine_time) VALUES (?,?,?,?,?,?)',
+                        (now, device, tracker, path, odo, engine_time))
+        self.db.execute('INSERT OR IGNORE INTO odometer (device, odo, engine_time) VALUES (?,0,0)', (device,))
+        self.db.execute('UPDATE odometer SET odo=odo+?, engine_time=engine_time+? WHERE device=?', (odo, engine_time, device))
+
+    def add_counters(self, device, tracker, path, odo, engine_time, digest=None, max_uploads=10000):
+        '''Add track distance and engine time to device odometer, returns new totals.
+           Payload `digest` is remembered in the same transaction, so a track is
+           skipped as resent only if it was counted'''
+        with self.db:
+            self._add_counters(device, tracker, path, odo, engine_time, time.time())
+            if digest!=None:
+               self._add_upload(digest, max_uploads)
+        return self.counters(device)
+
+    def counters(self, device):
+        row = self.db.execute('SELECT odo, engine_time FROM odometer WHERE device=?', (device,)).fetchone()
+        return { 'odo': row[0] if row else 0, 'engine_time': row[1] if row else 0 }
+
+    def odometer(self):
+        '''Return (device, odo, engine_time, tracks, odo from log, engine time from log)
+           for every device'''
+        return self.db.execute('''SELECT o.device, o.odo, o.engine_time, COUNT(l.path), SUM(l.odo), SUM(l.engine_time)
+                                  FROM odometer o LEFT JOIN odometer_log l ON l.device=o.device
+                                  GROUP BY o.device ORDER BY o.device''').fetchall()
+
+    def recompute_counters(self):
+        '''Rebuild odometer totals from the log'''
+        with self.db:
+            self.db.execute('DELETE FROM odometer')
+            self.db.execute('INSERT INTO odometer (device, odo, engine_time) SELECT device, SUM(odo), SUM(engine_time) FROM odometer_log GROUP BY device')
+
+    def migrate_counters(self, filename):
+        '''Import totals from old JSON counters file as initial log rows,
+           the file is renamed after import'''
+        if not os.path.exists(filename):
+           return
+        with open(filename, "rb") as f:
+             counters = json.load(f)
+        with self.db:
+            for device, c in counters.iteritems():
+                self._add_counters(device, None, None, c.get('odo', 0), c.get('engine_time', 0), os.path.getmtime(filename))
+        os.rename(filename, filename + ".migrated")
+        logging.info("Migrated counters of %d devices from %s", len(counters), filename)
+
+    def close(self):
+        self.db.close()
+
+
+def track_info(path, device, stat):
+    '''Catalog entry of a track from its trackstats statistics'''
+    return { 'path': path, 'device': device, 'start_time': stat['start_time'], 'end_time': stat['end_time'],
+             'distance': stat['distance'], 'bounds': stat['bounds'] }
+
+
+def index_archive(catalog, storage, reindex=False):
+    '''Add tracks stored in `storage` directory to the catalog, already
+       cataloged files are skipped unless `reindex`'''
+    known = set() if reindex else catalog.paths()
+    count = 0
+    for name in sorted(os.listdir(storage)):
+        m = TRACK_FILE.match(name)
+        if m==None or name in known:
+           continue
+        try:
+           stat = trackstats.arrays_stat( *gpxstream.read_arrays(os.path.join(storage, name)) )
+        except Exception as e:
+           logging.error("Can't index track %s: %s", name, e)
+           continue
+        catalog.add( **track_info(name, m.group(1), stat) )
+        count = count + 1
+    logging.info("Indexed %d tracks from %s", count, storage)
+    return count
+
+
+def parse_time(string):
+    '''Parse UTC date "YYYY-mm-dd[ HH:MM[:SS]]" into unix time'''
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+           return calendar.timegm( time.strptime(string, fmt) )
+        except ValueError:
+           pass
+    raise argparse.ArgumentTypeError("invalid date: %s" % string)
+
+
+def parse_bbox(string):
+    try:
+       bbox = tuple( float(x) for x in string.split(',') )
+    except ValueError:
+       bbox = ()
+    if len(bbox)!=4:
+       raise argparse.ArgumentTypeError("bbox should be min_lat,min_lon,max_lat,max_lon")
+    return bbox
+
+
+def format_time(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S") if timestamp!=None else '-'
+
+
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser( fromfile_prefix_chars='@', description="Query catalog of tracks stored by trackrec" )
+   parser.add_argument( "--storage", default="/tmp/" )
+   parser.add_argument( "--catalog", help="Catalog database, default is tracks.db in storage" )
+   parser.add_argument( "--index", action="store_true", default=False, help="Add not yet cataloged tracks from storage" )
+   parser.add_argument( "--reindex", action="store_true", default=False, help="Rebuild catalog entries of all tracks in storage" )
+   parser.add_argument( "--odometer", action="store_true", default=False, help="Show device odometers checked against per-track log" )
+   parser.add_argument( "--recompute", action="store_true", default=False, help="Rebuild odometer totals from per-track log" )
+   parser.add_argument( "--device" )
+   parser.add_argument( "--since", type=parse_time, help="UTC date: YYYY-mm-dd[ HH:MM[:SS]]" )
+   parser.add_argument( "--until", type=parse_time, help="UTC date: YYYY-mm-dd[ HH:MM[:SS]]" )
+   parser.add_argument( "--bbox", type=parse_bbox, help="Tracks passing through box min_lat,min_lon,max_lat,max_lon" )
+   parser.add_argument( "-v", action="store_true", default=False, help="Verbose logging", dest="verbose" )
+   parser.add_argument( "--logfile", help="Logging into file" )
+   args = parser.parse_args()
+
+   logging.basicConfig( format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level= logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
+
+   catalog = TrackCatalog( args.catalog or os.path.join(args.storage, "tracks.db") )
+   if args.index or args.reindex:
+      index_archive( catalog, args.storage, args.reindex )
+   elif args.recompute:
+      catalog.recompute_counters()
+   elif args.odometer:
+      for device, odo, engine_time, tracks, log_odo, log_engine_time in catalog.odometer():
+          mismatch = abs(odo-(log_odo or 0))>1e-6 or abs(engine_time-(log_engine_time or 0))>1e-6
+          print "%s\t%.3f km\t%.2f h\t%d tracks%s" % (device, odo, engine_time, tracks, "\tMISMATCH: log has %.3f km, %.2f h" % (log_odo or 0, log_engine_time or 0) if mismatch else "")
+   else:
+      for path, device, start_time, end_time, distance in catalog.query( args.device, args.since, args.until, args.bbox ):
+          print "%s\t%s\t%s\t%.3f\t%s" % (device, format_time(start_time), format_time(end_time), distance or 0, path)
+   catalog.close()
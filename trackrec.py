@@ -1,35 +1,177 @@
 #!/usr/bin/python
 
+import sys
 import logging
 import argparse
 import urlparse
 import paho.mqtt.client as mqtt
 import json, zlib
 import os.path
-import gpxpy.gpx
-from gpxpy.gpx import TimeBounds
 import datetime
+import time
+import signal
+import socket
+import collections
+import multiprocessing
+import Queue
+import hashlib
+import trackstats
+import gpxstream
+import trackdb
+import heatmap
+
+
+def decode_payload(payload):
+    data = {}
+    try:
+       data = json.loads(payload)
+    except:
+       try:
+          s = zlib.decompress(payload, 16+zlib.MAX_WBITS) #gzip.decompress(message.payload).decode("utf-8")
+          # logging.info("Decompressed data: %s", s)
+          data = json.loads(s)
+       except:
+          pass
+    return data
+
+
+def process_track(storage, device, tracker, payload, compress=False, heatmap_zooms=None):
+    '''Decode track payload, store it as GPX file (gzip compressed if `compress`)
+       and calculate its statistics. Runs in a worker process, returns
+       (device, tracker, stat, catalog entry, error). Catalog entry also has
+       heatmap pixels of the track if `heatmap_zooms` are set'''
+    try:
+       data = decode_payload(payload)
+       if "track" not in data:
+          return (device, tracker, None, None, None)
+
+       stat = trackstats.track_stat( data["track"] )
+       start_time = datetime.datetime.utcfromtimestamp(stat['start_time']) if stat['start_time']!=None else datetime.datetime.now()
+
+       filename = "%s-%s.gpx" % (device, start_time.strftime("%Y_%m_%d-%H_%M") )
+       if compress:
+          filename = filename + ".gz"
+       logging.info("Storing track to %s", filename)
+
+       f = gpxstream.open_gpx( os.path.join(storage, filename), "wb" )
+       try:
+          gpxstream.write_gpx( f, data["track"] )
+       finally:
+          f.close()
+
+       info = trackdb.track_info( filename, device, stat )
+       if heatmap_zooms:
+          info['pixels'] = heatmap.track_pixels( [ p['lat'] for p in data["track"] ], [ p['lon'] for p in data["track"] ], heatmap_zooms )
+       stat = { 'move_time': stat['move_time'], 'avg_speed': stat['avg_speed'], 'max_speed': stat['max_speed'], 'distance': stat['distance'] }
+       stat['_type'] = 'stat'
+       return (device, tracker, stat, info, None)
+    except Exception as e:
+       logging.exception("Error while process track")
+       return (device, tracker, None, None, str(e))
+
+
+def init_worker():
+    # worker processes are stopped by the recorder
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class LiveSegment:
+      '''Track assembled from location messages of a device'''
+      fields = ('lat', 'lon', 'alt', 'tst', 'vel')
+
+      def __init__(self, tracker):
+          self.tracker = tracker
+          self.points = []
+          self.stat = trackstats.RunningStat()
+          self.updated = time.time()
+
+      def add(self, location):
+          self.points.append( dict( (k, location[k]) for k in self.fields if k in location ) )
+          self.stat.add( location['lat'], location['lon'], location.get('alt'), location['tst'] )
+          self.updated = time.time()
+
+      def payload(self):
+          return json.dumps( {'_type': 'track', 'track': self.points} )
+
 
 class GPXRecorder:
-      def __init__(self, url, storage ):
+      '''Store tracks received over MQTT as GPX files and publish their statistics.
+         Tracks are decoded and processed in a pool of worker processes, MQTT client
+         and results are handled in the main thread. Tracks of one device are
+         processed in order they were received, at most `queue_size` tracks
+         can wait for processing.
+
+         If `idle_gap` is set tracks are also assembled from location messages,
+         running stats are published on every point and the segment is stored
+         as a track when there are no new points for `idle_gap` seconds.
+
+         Digests of last `dedup_size` processed payloads are kept in the catalog,
+         resent tracks are skipped before decoding'''
+      def __init__(self, url, storage, processes=None, queue_size=16, compress=False, catalog=None, idle_gap=None, dedup_size=10000, heatmap_dir=None ):
           self.url = url
+          self.storage = storage
+          self.compress = compress
+          self.catalog = trackdb.TrackCatalog( catalog or os.path.join(storage, "tracks.db") )
+          self.catalog.migrate_counters( "trackrec.dat" )
+          self.heatmap = heatmap.Heatmap( heatmap_dir ) if heatmap_dir!=None else None
+
+          self.pool = multiprocessing.Pool( processes, init_worker )
+          self.results = Queue.Queue()
+          self.pending = {}
+          self.busy = {}
+          self.queue_size = queue_size
+          self.queued = 0
+          self.dropped = 0
+          self.idle_gap = idle_gap
+          self.dedup_size = dedup_size
+          self.inflight = set()
+          self.duplicates = 0
+          self.live = {}
+
           self.mqttc = mqtt.Client()
           if url.username!=None:
               self.mqttc.username_pw_set( url.username, url.password )
 
           self.mqttc.on_connect = self.on_mqtt_connect
           self.mqttc.on_message = self.on_mqtt_message
-          self.storage = storage
-          self.counters = {}
-          self.load_counters()
 
       def start(self):
+          signal.signal(signal.SIGTERM, self.cleanup)
           self.mqttc.connect( self.url.hostname, self.url.port if self.url.port!=None else 1883, 60 )
           # mqtt broker
           logging.info("Trying connect to MQTT broker at %s:%d" % (self.url.hostname, self.url.port) )
-          self.mqttc.loop_forever()
+          try:
+             while True:
+                 rc = self.mqttc.loop( timeout=0.1 )
+                 if rc!=mqtt.MQTT_ERR_SUCCESS:
+                    logging.info("MQTT broker connection lost: %s; reconnecting in 5 seconds", mqtt.error_string(rc) )
+                    time.sleep(5)
+                    try:
+                       self.mqttc.reconnect()
+                    except socket.error:
+                       pass
+                 self.process_results()
+                 self.close_idle()
+          finally:
+             try:
+                self.close_live()
+                self.drain()
+                self.pool.close()
+                self.pool.join()
+             except:
+                # interrupted again, tracks left in workers are lost
+                self.pool.terminate()
+                raise
+             finally:
+                self.catalog.close()
  
 
+      def cleanup(self, signum, frame):
+          '''Exit on SIGTERM, open live tracks and queued tracks are stored on the way out'''
+          logging.info("Stopping on signal %d", signum)
+          sys.exit(signum)
+
       def on_mqtt_connect(self, client, userdata, flags, rc):
           logging.info("MQTT broker connection result: %s", mqtt.connack_string(rc) )
           if rc==0:
@@ -39,111 +181,143 @@ class GPXRecorder:
       def on_mqtt_message(self, client, userdata, message):
           logging.debug("Got mqtt message: %s %s", message.topic, message.payload )
           d = message.topic.split("/")
+          if len(d)<3:
+             return
           device, tracker = (d[1],d[2])
 
-          try:
-             data = {}
-             try:
-                data = json.loads(message.payload)
-             except:
-                try:
-                   s = zlib.decompress(message.payload, 16+zlib.MAX_WBITS) #gzip.decompress(message.payload).decode("utf-8")
-                   # logging.info("Decompressed data: %s", s)
-                   data = json.loads(s)
-                except:
-                   pass
+          if self.idle_gap!=None and len(d)==3 and '"location"' in message.payload:
+             self.on_location(client, device, tracker, message.payload)
+             return
 
-             if "track" in data:
-                gpx = self.track2gpx( data["track"] )
+          # only tracks (possibly gzip compressed) are worth passing to workers
+          if '"track"' not in message.payload and not message.payload.startswith('\x1f\x8b'):
+             return
+          self.enqueue(device, tracker, message.payload)
 
-                start_time = self.get_time_bounds( gpx ).start_time or datetime.datetime.now()
+      def enqueue(self, device, tracker, payload):
+          # devices resend the same track after reconnect
+          digest = hashlib.sha1(payload).digest()
+          if digest in self.inflight or self.catalog.has_upload(digest):
+             self.duplicates = self.duplicates + 1
+             logging.info("Skipping already received track of %s (%d skipped total)", device, self.duplicates)
+             return
 
-                filename = "%s-%s.gpx" % (device, start_time.strftime("%Y_%m_%d-%H_%M") )
-                logging.info("Storing track to %s", filename)
+          if self.queued>=self.queue_size:
+             self.dropped = self.dropped + 1
+             logging.warning("Track processing queue is full, track of %s dropped (%d dropped total)", device, self.dropped)
+             return
+          self.queued = self.queued + 1
+          self.inflight.add(digest)
+          self.pending.setdefault(device, collections.deque()).append( (tracker, payload, digest) )
+          self.submit(device)
 
-                f = open( os.path.join(self.storage, filename), "wb" )
-                f.write( gpx.to_xml() )
-                f.close()
+      def on_location(self, client, device, tracker, payload):
+          try:
+             location = json.loads(payload)
+          except ValueError:
+             return
+          if location.get('_type')!='location' or 'lat' not in location or 'lon' not in location or 'tst' not in location:
+             return
 
-                self.publish_stat(client, device, tracker, gpx )
-          except:
-             logging.exception("Error while process data from MQTT")
-          pass
+          segment = self.live.get(device)
+          if segment!=None and location['tst'] - segment.stat.end_time > self.idle_gap:
+             self.close_segment(device)
+             segment = None
+          if segment==None:
+             segment = self.live[device] = LiveSegment(tracker)
+          elif location['tst'] <= segment.stat.end_time:
+             # resent or out of order point
+             return
+          segment.add(location)
 
-      def get_time_bounds(self, gpx):
-          start_time = None
-          end_time = None
-          for point in gpx.get_points_data():
-              if point.point.time:
-                 if start_time==None and point.distance_from_start>0:
-                    start_time = point.point.time
-                 end_time = point.point.time
-          if start_time==None:
-             start_time=end_time
-          return TimeBounds(start_time,end_time)
-
-      def load_counters(self):
-          try:
-             fp = open("trackrec.dat","rb")
-             self.counters = json.load( fp )
-             fp.close()
-          except:
-             pass
-          pass
+          stat = segment.stat.stat()
+          stat['_type'] = 'live'
+          client.publish( 'owntracks/%s/%s/live' % (device,tracker), json.dumps(stat) )
 
-      def store_counters(self):
-          try:
-             fp = open("trackrec.dat","wt")
-             json.dump(self.counters, fp )
-             fp.close()
-          except:
-             pass
-          pass
+      def close_segment(self, device):
+          segment = self.live.pop(device)
+          logging.info("Closing live track of %s with %d points", device, len(segment.points))
+          if len(segment.points)>1:
+             self.enqueue(device, segment.tracker, segment.payload())
 
-      def publish_stat(self, client, device, tracker, gpx):
-          time_data = self.get_time_bounds( gpx )
-          move_data = gpx.get_moving_data()
+      def heatmap_zooms(self):
+          return self.heatmap.zooms if self.heatmap!=None else None
 
-          move_time = (time_data.end_time - time_data.start_time).total_seconds()
-          avg_speed = (move_data.moving_distance / move_time) if move_time!=0 else 0
+      def close_idle(self):
+          now = time.time()
+          for device, segment in self.live.items():
+              if now - segment.updated > self.idle_gap:
+                 self.close_segment(device)
 
-          self.load_counters()
+      def close_live(self):
+          # store open segments without the pool, it is about to be stopped
+          for device, segment in self.live.items():
+              if len(segment.points)>1:
+                 payload = segment.payload()
+                 self.handle_result( process_track(self.storage, device, segment.tracker, payload, self.compress, self.heatmap_zooms()), hashlib.sha1(payload).digest() )
+          self.live = {}
 
-          if device not in self.counters:
-             self.counters[device] = { 'odo': 0, 'engine_time': 0 }
+      def submit(self, device):
+          if device in self.busy or not self.pending.get(device):
+             return
+          tracker, payload, digest = self.pending[device].popleft()
+          self.busy[device] = digest
+          self.pool.apply_async( process_track, (self.storage, device, tracker, payload, self.compress, self.heatmap_zooms()), callback=self.results.put )
+
+      def process_results(self):
+          while True:
+             try:
+                result = self.results.get_nowait()
+             except Queue.Empty:
+                return
+             device = result[0]
+             self.queued = self.queued - 1
+             self.handle_result( result, self.busy.pop(device) )
+             self.submit(device)
 
-          self.counters[device]['odo']         = self.counters[device]['odo'] + move_data.moving_distance/1000
-          self.counters[device]['engine_time'] = self.counters[device]['engine_time'] + move_time/3600.0
+      def drain(self):
+          '''Wait until all accepted tracks are processed'''
+          if self.queued:
+             logging.info("Waiting for %d tracks to be processed", self.queued)
+          while self.busy:
+             time.sleep(0.1)
+             self.process_results()
 
-          self.store_counters()
+      def handle_result(self, result, digest):
+          device, tracker, stat, info, error = result
+          self.inflight.discard(digest)
+          if error!=None:
+             logging.error("Error while process data from MQTT: %s", error)
+             return
+          if stat==None:
+             # nothing to store, resent payload can be skipped
+             try:
+                self.catalog.add_upload(digest, self.dedup_size)
+             except Exception:
+                logging.exception("Error while store track digest")
+             return
+          pixels = info.pop('pixels', None)
+          try:
+             self.catalog.add( **info )
+          except Exception:
+             logging.exception("Error while add track %s to catalog", info['path'])
+          if pixels!=None:
+             try:
+                self.heatmap.add( info['path'], pixels )
+             except Exception:
+                logging.exception("Error while add track %s to heatmap", info['path'])
+          self.publish_stat(self.mqttc, device, tracker, stat, info['path'], digest)
 
-          stat = {
-             '_type': 'stat',
-             'move_time': move_time, 
-             'avg_speed': avg_speed*3.6, 
-             'max_speed': move_data.max_speed * 3.6, 
-             'distance': move_data.moving_distance/1000
-          }
-          stat.update( self.counters[device] )
+      def publish_stat(self, client, device, tracker, stat, path=None, digest=None):
+          stat = dict(stat)
+          try:
+             stat.update( self.catalog.add_counters( device, tracker, path, stat['distance'], stat['move_time']/3600.0, digest, self.dedup_size ) )
+          except Exception:
+             logging.exception("Error while update odometer of %s", device)
           logging.info( "Sendning stat for device:%s %s", device, json.dumps(stat) )
           client.publish( 'owntracks/%s/%s/stat' % (device,tracker),  json.dumps(stat), retain=True )
           pass
 
-      def track2gpx(self, track):
-          gpx = gpxpy.gpx.GPX()
-          gpx_track = gpxpy.gpx.GPXTrack()
-          gpx.tracks.append(gpx_track)
-          gpx_segment = gpxpy.gpx.GPXTrackSegment()
-          gpx_track.segments.append(gpx_segment)
-
-          for idx, p in enumerate(track):
-             point = gpxpy.gpx.GPXTrackPoint(
-                  p["lat"], p["lon"], elevation= p['alt'] if 'alt' in p else None, time=datetime.datetime.utcfromtimestamp( p["tst"] ), speed=p["vel"] if 'vel' in p else None,
-                  name = "Start" if idx==0 else ( "Finish" if idx==len(track)-1 else None )
-             )
-             gpx_segment.points.append( point )
-          return gpx
-
 if __name__ == "__main__":
    class LoadFromFile( argparse.Action ):
        def __call__ (self, parser, namespace, values, option_string = None):
@@ -152,6 +326,14 @@ if __name__ == "__main__":
 
    parser = argparse.ArgumentParser( fromfile_prefix_chars='@' )
    parser.add_argument( "--storage", default="/tmp/" )
+   parser.add_argument( "--processes", type=int, default=None, help="Number of track processing workers, default is number of CPUs" )
+   parser.add_argument( "--queue-size", type=int, default=16, help="Max tracks waiting for processing" )
+   parser.add_argument( "--gzip", action="store_true", default=False, help="Store tracks as gzip compressed .gpx.gz files" )
+   parser.add_argument( "--catalog", help="Track catalog database, default is tracks.db in storage" )
+   parser.add_argument( "--heatmap", help="Update heatmap in this directory with stored tracks" )
+   parser.add_argument( "--dedup-size", type=int, default=10000, help="Number of track digests kept to skip resent tracks" )
+   parser.add_argument( "--live", action="store_true", default=False, help="Assemble tracks from location messages" )
+   parser.add_argument( "--idle-gap", type=int, default=300, help="Close live track after this number of seconds without points" )
 
    parser.add_argument( "-c", "--config", type=open, action=LoadFromFile, help="Load config from file" )
    parser.add_argument( "-u","--url", default="mqtt://localhost:1883", type=urlparse.urlparse )
@@ -160,5 +342,5 @@ if __name__ == "__main__":
    args = parser.parse_args()
    logging.basicConfig( format="[%(asctime)s] [%(levelname)s] [%(name)s] %(message)s",  level= logging.DEBUG if args.verbose else logging.INFO, filename=args.logfile )
 
-   recorder = GPXRecorder( args.url, storage=args.storage )
+   recorder = GPXRecorder( args.url, storage=args.storage, processes=args.processes, queue_size=args.queue_size, compress=args.gzip, catalog=args.catalog, idle_gap=args.idle_gap if args.live else None, dedup_size=args.dedup_size, heatmap_dir=args.heatmap )
    recorder.start()
@@ -0,0 +1,157 @@
+import numpy
+import math
+
+# same constants and distance approximations as gpxpy uses
+EARTH_RADIUS = 6378137.0
+ONE_DEGREE = EARTH_RADIUS * math.pi / 180
+STOPPED_SPEED_THRESHOLD = 1.0
+
+
+def track_arrays(track):
+    '''Convert owntracks track (list of points) into lat, lon, alt, tst, vel
+       columns, missing values are NaN'''
+    size = len(track)
+    def column(name):
+        return numpy.fromiter( (numpy.nan if p.get(name) is None else p[name] for p in track), numpy.float64, size )
+    return column('lat'), column('lon'), column('alt'), column('tst'), column('vel')
+
+
+def distances(lat, lon, alt=None):
+    '''Distances in meters between consecutive points. Close points use flat
+       approximation, points more than 0.2 degree apart use haversine formula.
+       Elevation difference is accounted when both elevations are known'''
+    lat1, lat2 = lat[:-1], lat[1:]
+    lon1, lon2 = lon[:-1], lon[1:]
+    dlat = lat1 - lat2
+    dlon = lon1 - lon2
+
+    # gpxpy measures from the later point of a pair
+    coef = numpy.cos(lat2 / 180. * math.pi)
+    flat = numpy.sqrt(dlat*dlat + (dlon*coef)**2) * ONE_DEGREE
+
+    # haversine distance ignores elevation
+    far = (numpy.abs(dlat) > .2) | (numpy.abs(dlon) > .2)
+    if far.any():
+       a = numpy.sin(numpy.radians(dlat)/2)**2 + numpy.sin(numpy.radians(dlon)/2)**2 * numpy.cos(numpy.radians(lat1)) * numpy.cos(numpy.radians(lat2))
+       flat = numpy.where(far, EARTH_RADIUS * 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1-a)), flat)
+
+    if alt is None:
+       return flat
+    dalt = numpy.nan_to_num(alt[:-1] - alt[1:]) * ~far
+    return numpy.sqrt(flat*flat + dalt*dalt)
+
+
+def time_bounds(lat, lon, alt, tst):
+    '''Return (start, end) timestamps, track starts when the point first moves
+       away from the start point'''
+    if len(tst)==0:
+       return (None, None)
+    moved = numpy.flatnonzero( numpy.cumsum(distances(lat, lon, alt)) > 0 )
+    end = tst[-1]
+    start = tst[moved[0]+1] if len(moved) else end
+    return (start, end)
+
+
+def bounds(lat, lon):
+    '''Return bounding box (min_lat, min_lon, max_lat, max_lon) or None for empty track'''
+    if len(lat)==0:
+       return None
+    return (float(lat.min()), float(lon.min()), float(lat.max()), float(lon.max()))
+
+
+def max_speed(speeds, dists):
+    '''Max speed ignoring steps with extreme distances and top 5% of speeds'''
+    if len(speeds) < 20:
+       return 0.
+    average = dists.mean()
+    deviation = math.sqrt( ((dists-average)**2).mean() )
+    speeds = numpy.sort( speeds[numpy.abs(dists-average) <= deviation*1.5] )
+    if len(speeds)==0:
+       return 0.
+    index = int(len(speeds) * 0.95)
+    if index >= len(speeds):
+       index = -1
+    return float(speeds[index])
+
+
+def moving_data(lat, lon, alt, tst, stopped_speed_threshold=STOPPED_SPEED_THRESHOLD):
+    '''Return (moving_time, stopped_time, moving_distance, stopped_distance, max_speed),
+       steps slower than threshold (km/h) are treated as stopped'''
+    # zero elevation is treated as unknown here, like gpxpy does
+    dists = distances(lat, lon, numpy.where(alt==0, numpy.nan, alt))
+    seconds = numpy.diff(tst)
+
+    speed_kmh = numpy.zeros(len(seconds))
+    positive = seconds > 0
+    speed_kmh[positive] = (dists[positive] / 1000.) / (seconds[positive] / 3600.)
+    moving = speed_kmh > stopped_speed_threshold
+
+    return ( float(seconds[moving].sum()), float(seconds[~moving].sum()),
+             float(dists[moving].sum()), float(dists[~moving].sum()),
+             max_speed(dists[moving] / seconds[moving], dists[moving]) )
+
+
+def track_stat(track, stopped_speed_threshold=STOPPED_SPEED_THRESHOLD):
+    '''Calculate statistics of owntracks track: time bounds (unix time), move time (seconds),
+       distance (km), average and max speed (km/h), bounding box'''
+    lat, lon, alt, tst, vel = track_arrays(track)
+    return arrays_stat(lat, lon, alt, tst, stopped_speed_threshold)
+
+
+def arrays_stat(lat, lon, alt, tst, stopped_speed_threshold=STOPPED_SPEED_THRESHOLD):
+    '''Same as track_stat for track already in columns (see gpxstream.read_arrays)'''
+    start, end = time_bounds(lat, lon, alt, tst)
+    moving_time, stopped_time, moving_distance, stopped_distance, speed = moving_data(lat, lon, alt, tst, stopped_speed_threshold)
+
+    move_time = float(end - start) if start is not None else 0.
+    avg_speed = (moving_distance / move_time) if move_time!=0 else 0
+    return {
+       'start_time': start,
+       'end_time': end,
+       'bounds': bounds(lat, lon),
+       'move_time': move_time,
+       'avg_speed': avg_speed*3.6,
+       'max_speed': speed*3.6,
+       'distance': moving_distance/1000
+    }
+
+
+class RunningStat:
+    '''Statistics of a track updated point by point with the same distance and
+       moving rules as track_stat. Max speed needs the whole track, so running
+       stats report speed of the last step instead'''
+    def __init__(self, stopped_speed_threshold=STOPPED_SPEED_THRESHOLD):
+        self.stopped_speed_threshold = stopped_speed_threshold
+        self.last = None
+        self.start_time = None
+        self.end_time = None
+        self.moving_distance = 0.
+        self.speed = 0.
+
+    def add(self, lat, lon, alt, tst):
+        alt = numpy.nan if alt is None else alt
+        if self.last!=None:
+           lat0, lon0, alt0, tst0 = self.last
+           lats = numpy.array([lat0, lat])
+           lons = numpy.array([lon0, lon])
+           alts = numpy.array([alt0, alt])
+           if self.start_time==None and distances(lats, lons, alts)[0] > 0:
+              self.start_time = tst
+           dist = distances(lats, lons, numpy.where(alts==0, numpy.nan, alts))[0]
+           seconds = tst - tst0
+           self.speed = (dist / 1000.) / (seconds / 3600.) if seconds > 0 else 0.
+           if self.speed > self.stopped_speed_threshold:
+              self.moving_distance = self.moving_distance + dist
+        self.last = (lat, lon, alt, tst)
+        self.end_time = tst
+
+    def stat(self):
+        move_time = float(self.end_time - self.start_time) if self.start_time!=None else 0.
+        return {
+           'start_time': self.start_time if self.start_time!=None else self.end_time,
+           'end_time': self.end_time,
+           'move_time': move_time,
+           'avg_speed': (self.moving_distance / move_time * 3.6) if move_time!=0 else 0,
+           'speed': self.speed,
+           'distance': self.moving_distance/1000
+        }